@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import struct
+import tempfile
+import argparse
+from datetime import datetime
+from contextlib import redirect_stdout
+from pgmagick import Image, Blob, Geometry
+from directory_exif_mtime import ExifDirectory
+
+# Every kind of DateTime that date_taken handles differently, None is an EXIF segment without a DateTime
+VARIANTS = [
+    ('datetime', '2020:01:02 12:00:00'),
+    ('milliseconds', '1577966400000'),
+    ('hour_24', '2020:01:02 24:30:00'),
+    ('invalid', '2020-01-02T12:00:00'),
+    ('unknown', 'unknown'),
+    ('no_datetime', None),
+    ('no_exif', None),
+    ('malformed_exif', None)
+]
+
+
+class SyntheticCorpus:
+    def __init__(self, path, count, width, height):
+        self.path = path
+        self.count = count
+        self.width = width
+        self.height = height
+
+    def create(self):
+        data = self.encode()
+        for variant, exif_time in VARIANTS:
+            os.makedirs(os.path.join(self.path, variant), exist_ok=True)
+            image = self.with_segment(data, self.segment(variant, exif_time))
+            for i in range(self.count):
+                with open(os.path.join(self.path, variant, "img%05d.jpg" % i), 'wb') as f:
+                    f.write(image)
+
+    def encode(self):
+        # A plasma fractal compresses about as well as a photo, so a full decode costs about the same
+        img = Image()
+        img.size(Geometry(self.width, self.height))
+        img.read("plasma:fractal")
+        img.magick("JPEG")
+        img.quality(90)
+        blob = Blob()
+        img.write(blob)
+        return blob.data
+
+    def segment(self, variant, exif_time):
+        if variant == 'no_exif':
+            return None
+        if variant == 'malformed_exif':
+            return b'Exif\x00\x00' + b'XX*\x00' + struct.pack('<I', 8)
+
+        # A minimal IFD0 with the orientation and the DateTime as ASCII, which is always too long to fit in the entry itself
+        entries = [struct.pack('<HHIHH', 0x0112, 3, 1, 1, 0)]
+        value = b''
+        if exif_time is not None:
+            value = exif_time.encode('ascii') + b'\x00'
+            entries.append(struct.pack('<HHII', 0x0132, 2, len(value), 8 + 2 + 12 * 2 + 4))
+        tiff = b'II*\x00' + struct.pack('<I', 8) + struct.pack('<H', len(entries)) + b''.join(entries) + struct.pack('<I', 0) + value
+        return b'Exif\x00\x00' + tiff
+
+    def with_segment(self, data, payload):
+        # Insert the segment right after the start of image marker
+        if payload is None:
+            return data
+        return data[:2] + b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload + data[2:]
+
+
+class TracedExifDirectory(ExifDirectory):
+    # Remembers which way the last date was read and what was read
+    def date_taken(self, path, header=None):
+        self.reader = 'header'
+        self.exif_time = None
+        return super().date_taken(path, header)
+
+    def read_exif_time(self, path):
+        self.reader = 'exif'
+        return super().read_exif_time(path)
+
+    def read_pgmagick_time(self, path):
+        self.reader = 'pgmagick'
+        return super().read_pgmagick_time(path)
+
+    def parse_exif_time(self, path, exif_time):
+        self.exif_time = exif_time
+        return super().parse_exif_time(path, exif_time)
+
+
+class ExifDateBenchmark:
+    def __init__(self, corpus_path, repeat, timezone_name):
+        self.corpus_path = os.path.abspath(corpus_path)
+        self.repeat = repeat
+        self.directory = TracedExifDirectory(self.corpus_path, timezone_name)
+
+    def images(self):
+        images = []
+        for root, dirs, files in os.walk(self.corpus_path):
+            for file in files:
+                if self.directory.is_image(file):
+                    images.append(os.path.join(root, file))
+        return sorted(images)
+
+    def exif_time_format(self, exif_time):
+        # The same order as ExifDirectory.parse_exif_time tries them in
+        if not exif_time or exif_time == 'unknown':
+            return 'missing'
+        try:
+            datetime.strptime(exif_time, '%Y:%m:%d %H:%M:%S')
+            return 'datetime'
+        except ValueError:
+            pass
+        if re.match('^[0-9]{13}$', exif_time):
+            return 'milliseconds'
+        if re.match('^([0-9]{4}:[0-9]{2}:[0-9]{2}) 24:([0-9]{2}:[0-9]{2})$', exif_time):
+            return 'hour_24'
+        return 'invalid'
+
+    def measure(self):
+        images = self.images()
+        readers = {}
+        formats = {}
+        variants = {}
+        elapsed = 0.0
+        with redirect_stdout(io.StringIO()):
+            for i in range(self.repeat):
+                for image in images:
+                    start = time.perf_counter()
+                    try:
+                        self.directory.date_taken(image)
+                        reader = self.directory.reader
+                        exif_time_format = self.exif_time_format(self.directory.exif_time)
+                    except Exception:
+                        # Anything raised here would stop directory_exif_mtime.py, so it's counted instead
+                        reader = 'error'
+                        exif_time_format = 'error'
+                    seconds = time.perf_counter() - start
+                    elapsed += seconds
+
+                    variant = os.path.relpath(image, self.corpus_path).split(os.sep)[0]
+                    for stats, key in ((readers, reader), (formats, exif_time_format), (variants, variant)):
+                        stat = stats.setdefault(key, {'files': 0, 'seconds': 0.0})
+                        stat['files'] += 1
+                        stat['seconds'] += seconds
+                    variants[variant].setdefault('readers', {}).setdefault(reader, 0)
+                    variants[variant]['readers'][reader] += 1
+
+        count = len(images) * self.repeat
+        for stats in (readers, formats, variants):
+            for stat in stats.values():
+                stat['share_of_files'] = stat['files'] / max(1, count)
+                stat['share_of_time'] = stat['seconds'] / elapsed if elapsed > 0 else 0.0
+                stat['files_per_second'] = stat['files'] / stat['seconds'] if stat['seconds'] > 0 else 0.0
+
+        return {
+            'files': count,
+            'files_per_second': count / elapsed if elapsed > 0 else 0.0,
+            'readers': readers,
+            'formats': formats,
+            'variants': variants
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how fast directory_exif_mtime.py reads the dates of images and which way they are read, and outputs the result as JSON")
+    parser.add_argument("--corpus", help="A folder with images to use instead of generating a synthetic corpus, the first level of subfolders are reported as variants")
+    parser.add_argument("--count", type=int, default=20, help="Amount of images of every variant in the synthetic corpus")
+    parser.add_argument("--resolution", default="4000x3000", help="Size of the images in the synthetic corpus as WIDTHxHEIGHT, matters for the full decode fallback")
+    parser.add_argument("--repeat", type=int, default=1, help="How many times to go through the images")
+    parser.add_argument('--timezone', default="UTC", help="The timezone to use")
+    parser.add_argument("--output", help="File to write the JSON result to instead of stdout")
+
+    args = parser.parse_args()
+    m = re.match('^([0-9]+)x([0-9]+)$', args.resolution)
+    if not m:
+        parser.error("Resolution must be WIDTHxHEIGHT")
+
+    with tempfile.TemporaryDirectory() as corpus_path:
+        if args.corpus:
+            corpus_path = args.corpus
+        else:
+            SyntheticCorpus(corpus_path, args.count, int(m.group(1)), int(m.group(2))).create()
+
+        result = {
+            'corpus': corpus_path if args.corpus else {'count': args.count, 'resolution': args.resolution, 'variants': [variant for variant, exif_time in VARIANTS]},
+            'repeat': args.repeat
+        }
+        result.update(ExifDateBenchmark(corpus_path, args.repeat, args.timezone).measure())
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
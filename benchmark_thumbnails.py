@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import struct
+import resource
+import tempfile
+import argparse
+from contextlib import redirect_stdout
+from multiprocessing import Process, Queue
+# Imported first so the GraphicsMagick resource limits it sets are in place before pgmagick is loaded
+from directory_thumbnails import ThumbnailGenerator, ThumbnailIndex, ThumbnailDirectory, ThumbnailJobs, ThumbnailProfile, BACKENDS, DEFAULT_PROFILES, parse_profile
+
+# The corpus is made with whichever imaging library is installed, like the backends
+try:
+    from pgmagick import Image as PgImage, Blob, Geometry
+except ImportError:
+    PgImage = None
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+RESOLUTIONS = [(640, 480), (1920, 1080), (4000, 3000), (6000, 4000)]
+ORIENTATIONS = [1, 3, 6, 8]
+
+
+class SyntheticCorpus:
+    def __init__(self, path, count, depth, seed):
+        self.path = path
+        self.count = count
+        self.depth = depth
+        self.seed = seed
+
+    def create(self):
+        rng = random.Random(self.seed)
+        images = {}
+        for i in range(self.count):
+            # Cycle through every combination of resolution and orientation
+            width, height = RESOLUTIONS[i % len(RESOLUTIONS)]
+            orientation = ORIENTATIONS[(i // len(RESOLUTIONS)) % len(ORIENTATIONS)]
+            if (width, height) not in images:
+                images[(width, height)] = self.encode(width, height)
+
+            directory = os.path.join(self.path, *["dir%d" % rng.randrange(3) for level in range(rng.randint(0, self.depth))])
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, "img%05d.jpg" % i), 'wb') as f:
+                f.write(self.with_orientation(images[(width, height)], orientation))
+
+    def encode(self, width, height):
+        if PgImage is None:
+            return self.encode_pillow(width, height)
+
+        # A plasma fractal compresses about as well as a photo, unlike a single color
+        img = PgImage()
+        img.size(Geometry(width, height))
+        img.read("plasma:fractal")
+        img.magick("JPEG")
+        img.quality(90)
+        blob = Blob()
+        img.write(blob)
+        return blob.data
+
+    def encode_pillow(self, width, height):
+        # Pillow has no plasma, gradients with some noise on top compress about as well as a photo
+        gradient = PILImage.linear_gradient('L').resize((width, height))
+        radial = PILImage.radial_gradient('L').resize((width, height))
+        noise = PILImage.effect_noise((width, height), 24)
+        img = PILImage.merge('RGB', (gradient, radial, PILImage.blend(gradient, noise, 0.5)))
+        data = io.BytesIO()
+        img.save(data, 'JPEG', quality=90)
+        return data.getvalue()
+
+    def with_orientation(self, data, orientation):
+        # Insert a minimal EXIF segment with only the orientation tag right after the start of image marker
+        tiff = b'II*\x00' + struct.pack('<I', 8) + struct.pack('<H', 1) + struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0) + struct.pack('<I', 0)
+        payload = b'Exif\x00\x00' + tiff
+        return data[:2] + b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload + data[2:]
+
+
+class ThumbnailBenchmark:
+    def __init__(self, corpus_path, repeat, profiles, backend):
+        self.corpus_path = os.path.abspath(corpus_path)
+        self.repeat = repeat
+        self.profiles = profiles
+        self.backend = backend
+
+    def images(self):
+        images = []
+        for root, dirs, files in os.walk(self.corpus_path):
+            for file in files:
+                if file.lower().endswith('.jpg') or file.lower().endswith('.jpeg'):
+                    images.append(os.path.join(root, file))
+        return sorted(images)
+
+    def run(self, target, *args):
+        # Run every measurement in its own process so the peak memory usage isn't shared between them
+        queue = Queue()
+        process = Process(target=target, args=args + (queue,))
+        process.start()
+        result = queue.get()
+        process.join()
+        return result
+
+    def peak_rss_mb(self):
+        # ru_maxrss is reported in kilobytes on Linux, worker processes are included once they have been waited for
+        return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+    def measure_generator(self, generator, queue):
+        images = self.images()
+        stages = {}
+        with tempfile.TemporaryDirectory() as target_path, redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for i in range(self.repeat):
+                for j, image in enumerate(images):
+                    durations, info = generator.generate(image, {profile.name: os.path.join(target_path, profile.name, profile.thumb_name("%s.jpg" % j)) for profile in self.profiles})
+                    for stage, seconds in durations.items():
+                        stages[stage] = stages.get(stage, 0.0) + seconds
+            elapsed = time.perf_counter() - start
+
+        count = len(images) * self.repeat
+        queue.put({
+            'images': count,
+            'images_per_second': count / elapsed if elapsed > 0 else 0.0,
+            'stage_seconds_per_image': {stage: seconds / max(1, count) for stage, seconds in stages.items()},
+            'peak_rss_mb': self.peak_rss_mb()
+        })
+
+    def measure_output(self, queue):
+        # Compare the size of the thumbs with the same sizes written as plain JPEG with the default quality
+        baseline = [ThumbnailProfile(profile.name, profile.width, profile.height, profile.crop) for profile in self.profiles]
+        sizes = {}
+        with tempfile.TemporaryDirectory() as target_path, redirect_stdout(io.StringIO()):
+            for key, profiles in (('bytes', self.profiles), ('jpeg_bytes', baseline)):
+                generator = ThumbnailGenerator(profiles, backend=self.backend)
+                for j, image in enumerate(self.images()):
+                    thumb_paths = {profile.name: os.path.join(target_path, key, profile.name, profile.thumb_name("%s.jpg" % j)) for profile in profiles}
+                    generator.generate(image, thumb_paths)
+                    for name, path in thumb_paths.items():
+                        sizes.setdefault(name, {'bytes': 0, 'jpeg_bytes': 0})[key] += os.path.getsize(path)
+
+        for profile in self.profiles:
+            size = sizes.get(profile.name, {'bytes': 0, 'jpeg_bytes': 0})
+            size['saved_percent'] = 100.0 * (1 - size['bytes'] / size['jpeg_bytes']) if size['jpeg_bytes'] > 0 else 0.0
+        queue.put({str(profile): sizes.get(profile.name) for profile in self.profiles})
+
+    def measure_directory(self, workers, queue):
+        with tempfile.TemporaryDirectory() as target_path, redirect_stdout(io.StringIO()):
+            directory = ThumbnailDirectory(self.corpus_path, target_path, ThumbnailIndex(target_path), self.profiles)
+            jobs = ThumbnailJobs(ThumbnailGenerator(self.profiles, backend=self.backend), workers)
+
+            start = time.perf_counter()
+            directory.update_all(jobs)
+            generate_seconds = time.perf_counter() - start
+
+            # The second pass doesn't have anything to generate so it only measures the scan
+            start = time.perf_counter()
+            directory.update_all(jobs)
+            scan_seconds = time.perf_counter() - start
+
+            if jobs.executor is not None:
+                jobs.executor.shutdown()
+
+        count = len(self.images())
+        queue.put({
+            'workers': workers,
+            'images': count,
+            'images_per_second': count / generate_seconds if generate_seconds > 0 else 0.0,
+            'unchanged_scan_seconds': scan_seconds,
+            'peak_rss_mb': self.peak_rss_mb()
+        })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the time and memory used for generating thumbnails and outputs the result as JSON")
+    parser.add_argument("--corpus", help="A folder with images to use instead of generating a synthetic corpus")
+    parser.add_argument("--count", type=int, default=32, help="Amount of images in the synthetic corpus")
+    parser.add_argument("--depth", type=int, default=3, help="Max depth of folders in the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0, help="Seed used for placing images in the synthetic corpus")
+    parser.add_argument("--repeat", type=int, default=1, help="How many times to go through the images when measuring the generator")
+    parser.add_argument("--workers", type=int, default=1, help="Amount of processes to generate thumbnails in when measuring the directory")
+    parser.add_argument("--profile", action='append', type=parse_profile, help="A thumbnail size as NAME:WIDTHxHEIGHT[:fit|crop[:FORMAT[:QUALITY]]], defaults to the same as directory_thumbnails.py")
+    parser.add_argument("--backend", action='append', choices=sorted(BACKENDS), help="A backend to measure, defaults to every backend that is installed")
+    parser.add_argument("--output", help="File to write the JSON result to instead of stdout")
+
+    args = parser.parse_args()
+    profiles = args.profile or DEFAULT_PROFILES
+
+    backends = []
+    for name in args.backend or sorted(BACKENDS):
+        try:
+            backends.append(BACKENDS[name]())
+        except RuntimeError as e:
+            if args.backend:
+                parser.error(str(e))
+    if len(backends) == 0:
+        parser.error("None of the backends are installed")
+
+    with tempfile.TemporaryDirectory() as corpus_path:
+        if args.corpus:
+            corpus_path = args.corpus
+        else:
+            SyntheticCorpus(corpus_path, args.count, args.depth, args.seed).create()
+
+        result = {
+            'corpus': corpus_path if args.corpus else {'count': args.count, 'depth': args.depth, 'seed': args.seed},
+            'profiles': [str(profile) for profile in profiles],
+            'backends': {}
+        }
+
+        # Every backend is measured on the same corpus
+        for backend in backends:
+            benchmark = ThumbnailBenchmark(corpus_path, args.repeat, profiles, backend)
+            result['backends'][backend.name] = {
+                'generator': {
+                    'full_decode': benchmark.run(benchmark.measure_generator, ThumbnailGenerator(profiles, size_hint=False, backend=backend)),
+                    'size_hint': benchmark.run(benchmark.measure_generator, ThumbnailGenerator(profiles, size_hint=True, backend=backend))
+                },
+                'output': benchmark.run(benchmark.measure_output),
+                'directory': benchmark.run(benchmark.measure_directory, args.workers)
+            }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
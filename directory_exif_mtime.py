@@ -8,17 +8,175 @@ import exif
 import pgmagick
 import argparse
 import re
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+from directory_scanner import DirectoryScanner, ScannedDirectory, list_directory
+from jpeg_header import read_header
+from media_index import MediaIndex
+
+NOT_CACHED = object()
+
+
+class ExifEventHandler(FileSystemEventHandler):
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        # When every path last changed, and the size and mtime it had when it was last checked
+        self.paths = {}
+        self.signatures = {}
+
+    def add_path(self, path):
+        with self.lock:
+            self.paths[path] = time.time()
+        self.changed.set()
+
+    def take_paths(self, settle):
+        # Every path is taken once it hasn't changed for a while on its own, so images still being copied are complete
+        # while the ones that are done don't have to wait for the rest of a long import
+        while True:
+            now = time.time()
+            with self.lock:
+                due = [path for path, changed in self.paths.items() if changed + settle <= now]
+                for path in due:
+                    del self.paths[path]
+                self.changed.clear()
+
+            settled = set(path for path in due if self.is_settled(path, now, settle))
+            if len(settled) > 0:
+                return settled
+
+            with self.lock:
+                timeout = min(self.paths.values()) + settle - now if len(self.paths) > 0 else None
+            self.changed.wait(max(0, timeout) if timeout is not None else None)
+
+    def is_settled(self, path, now, settle):
+        # Wait until it hasn't been written to for a while, or hasn't changed since last time when the clock is off
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.signatures.pop(path, None)
+            return True
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if now - stat.st_mtime < settle and signature != self.signatures.get(path):
+            self.signatures[path] = signature
+            with self.lock:
+                self.paths.setdefault(path, now)
+            return False
+        self.signatures.pop(path, None)
+        return True
+
+    def on_created(self, event):
+        self.add_path(event.src_path)
+
+    def on_modified(self, event):
+        # Setting the mtime is a modification as well, those are only from this script when it's the same mtime that was set
+        if self.directory.is_own_change(event.src_path) or event.is_directory:
+            return
+        self.add_path(event.src_path)
+
+    def on_moved(self, event):
+        self.add_path(event.dest_path)
 
 
 class ExifDirectory:
-    def __init__(self, source_path, timezone_name):
+    def __init__(self, source_path, timezone_name, cache_path=None, workers=1, media=None):
         self.source_path = os.path.abspath(source_path)
         self.timezone = pytz.timezone(timezone_name)
+        self.connection = sqlite3.connect(cache_path) if cache_path else None
+        self.media = media
+
+        # Files are read and changed in parallel, everything using the cache stays in this thread
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.map = self.executor.map if self.executor else map
+        self.scanner = DirectoryScanner(self.connection, executor=self.executor, stat_file=self.is_image)
+
+        # The mtimes set by this script while watching, so the events they cause can be ignored
+        self.lock = threading.Lock()
+        self.own_changes = None
+        if self.connection:
+            # The mtime isn't part of the key since it's what is changed, the inode changes when a file is replaced
+            self.connection.execute("CREATE TABLE IF NOT EXISTS dates (path TEXT PRIMARY KEY, size INTEGER, inode INTEGER, date INTEGER)")
 
     def is_image(self, file):
         return file.lower().endswith('.jpg') or file.lower().endswith('.jpeg')
 
-    def date_taken(self, path):
+    def header(self, path, header=None):
+        return header or read_header(path)
+
+    def try_header(self, path, header=None):
+        # A file that can't be read is left as it is, one broken image mustn't stop the others
+        try:
+            return self.header(path, header)
+        except OSError as e:
+            print("Error reading %s: %s" % (path, e))
+            return None
+
+    def try_date_taken(self, path, header):
+        if header is None:
+            return NOT_CACHED
+        try:
+            return self.date_taken(path, header)
+        except Exception as e:
+            # The fallbacks use libraries that raise all kinds of errors for broken files
+            print("Error reading the date of %s: %s" % (path, e))
+            return NOT_CACHED
+
+    def date_taken(self, path, header=None):
+        # Only the segments before the image data are read, the whole file is only read if they couldn't be parsed
+        header = self.header(path, header)
+        if header.exif:
+            exif_time = header.datetime or header.datetime_original
+        elif header.width is not None:
+            # Parsed all the way to the image data without finding any EXIF, so there is no date to find elsewhere either
+            return None
+        else:
+            exif_time = self.read_exif_time(path)
+        return self.parse_exif_time(path, exif_time)
+
+    def parse_exif_time(self, path, exif_time):
+        if not exif_time or exif_time == 'unknown':
+            return None
+        else:
+            try:
+                return int(self.timezone.localize(datetime.strptime(exif_time, '%Y:%m:%d %H:%M:%S')).timestamp())
+            except:
+                if re.match('^[0-9]{13}$', exif_time):
+                    return int(int(exif_time) / 1000)
+                m = re.match('^([0-9]{4}:[0-9]{2}:[0-9]{2}) 24:([0-9]{2}:[0-9]{2})$', exif_time)
+                if m:
+                    return int(self.timezone.localize(datetime.strptime(('%s 23:%s' % (m.group(1), m.group(2))), '%Y:%m:%d %H:%M:%S')).timestamp()) + 3600
+                print("Invalid DateTime in EXIF for %s: %s" % (path, exif_time))
+                return None
+
+    def cached_date(self, path, stat):
+        if not self.connection:
+            return NOT_CACHED
+
+        row = self.connection.execute("SELECT size, inode, date FROM dates WHERE path = ?", (path,)).fetchone()
+        if row and row[:2] == (stat.st_size, stat.st_ino):
+            return row[2]
+        return NOT_CACHED
+
+    def cache_date(self, path, stat, date):
+        if self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO dates VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_ino, date))
+
+    def prune_cached_dates(self, root, files):
+        # Forget the files that are no longer in the directory
+        if not self.connection:
+            return
+        names = set(file.name for file in files)
+        rows = self.connection.execute("SELECT path FROM dates WHERE path >= ? AND path < ?", (root + '/', root + '0')).fetchall()
+        for row in rows:
+            if os.path.dirname(row[0]) == root and os.path.basename(row[0]) not in names:
+                self.connection.execute("DELETE FROM dates WHERE path = ?", (row[0],))
+
+    def read_exif_time(self, path):
         with open(path, 'rb') as data:
             exif_time = None
 
@@ -29,56 +187,150 @@ class ExifDirectory:
                 elif hasattr(img, 'datetime_original'):
                     exif_time = img.datetime_original
             except KeyError as e:
-                img = pgmagick.Image(path)
-                exif_time = img.attribute('exif:DateTime')
+                exif_time = self.read_pgmagick_time(path)
 
-            if not exif_time or exif_time == 'unknown':
-                return None
-            else:
-                try:
-                    return int(self.timezone.localize(datetime.strptime(exif_time, '%Y:%m:%d %H:%M:%S')).timestamp())
-                except:
-                    if re.match('^[0-9]{13}$', exif_time):
-                        return int(int(exif_time) / 1000)
-                    m = re.match('^([0-9]{4}:[0-9]{2}:[0-9]{2}) 24:([0-9]{2}:[0-9]{2})$', exif_time)
-                    if m:
-                        return int(self.timezone.localize(datetime.strptime(('%s 23:%s' % (m.group(1), m.group(2))), '%Y:%m:%d %H:%M:%S')).timestamp()) + 3600
-                    print("Invalid DateTime in EXIF for %s: %s" % (path, exif_time))
-                    return None
+            return exif_time
+
+    def read_pgmagick_time(self, path):
+        # Decodes the whole image, only used when the exif library can't find the EXIF data
+        img = pgmagick.Image(path)
+        return img.attribute('exif:DateTime')
 
     def update(self):
         print("Traversing %s for updates" % self.source_path)
 
-        paths = []
-        for root, dirs, files in os.walk(self.source_path):
-            paths.append((root, files, os.stat(root).st_mtime))
+        # Only the directories that have changed since the last run are listed when there is a cache
+        paths = list(self.scanner.scan(self.source_path))
 
         #Newest created folders first
-        paths.sort(key=lambda a: a[2], reverse=True)
+        paths.sort(key=lambda a: a.stat.st_mtime, reverse=True)
 
         for p in paths:
-            self.update_dir(p[0], p[1])
+            self.update_dir(p.path, p.files)
+
+            self.done(p)
+            self.commit()
     
     def update_dir(self, root, files):
-        max_date = None
-        for file in files:
-            if self.is_image(file):
-                path = os.path.abspath(os.path.join(root, file))
-                date = self.date_taken(path)
-                
-                if date:
-                    max_date = max(max_date, date) if max_date else date
-                    self.update_utime(path, date)
-        
-        if max_date:
-            self.update_utime(root, max_date)
-
-    def update_utime(self, path, date):
-        current = os.stat(path)
-        
+        images = [file for file in files if self.is_image(file.name)]
+
+        # Files that have been read before are neither opened nor parsed again
+        dates = {}
+        missing = []
+        for file in images:
+            date = self.cached_date(file.path, file.stat())
+            if date is NOT_CACHED:
+                missing.append(file)
+            else:
+                dates[file.path] = date
+
+        # Headers already parsed by this or another script are taken from the media index
+        paths = [file.path for file in missing]
+        known = [self.media.get(file.path, file.stat()) if self.media else None for file in missing]
+        headers = list(self.map(self.try_header, paths, known))
+        if self.media:
+            for file, header, known_header in zip(missing, headers, known):
+                if known_header is None and header is not None:
+                    self.media.put(file.path, file.stat(), header)
+
+        # A file that couldn't be read has no date, and isn't cached so it's tried again the next time
+        for file, date in zip(missing, self.map(self.try_date_taken, paths, headers)):
+            if date is NOT_CACHED:
+                dates[file.path] = None
+                continue
+            self.cache_date(file.path, file.stat(), date)
+            dates[file.path] = date
+
+        # Every file is done before the directory gets the date of the newest one
+        dated = [file for file in images if dates[file.path]]
+        list(self.map(self.update_utime, [file.path for file in dated], [dates[file.path] for file in dated], [file.stat() for file in dated]))
+
+        self.prune_cached_dates(root, files)
+
+        if len(dated) > 0:
+            self.update_utime(root, max(dates[file.path] for file in dated))
+
+    def watch(self, settle):
+        self.own_changes = {}
+        handler = ExifEventHandler(self)
+        observer = Observer()
+        observer.schedule(handler, path=self.source_path, recursive=True)
+        observer.start()
+        print("Watching %s for updates" % self.source_path)
+
+        try:
+            while True:
+                self.update_paths(handler.take_paths(settle))
+        except KeyboardInterrupt:
+            observer.stop()
+        observer.join()
+
+    def update_paths(self, paths):
+        roots = set()
+        for path in paths:
+            if os.path.isdir(path):
+                # A directory that is created or moved here has to be traversed like on start
+                for p in self.scanner.scan(path):
+                    self.update_dir(p.path, p.files)
+                    self.done(p)
+            elif self.is_image(path) and os.path.exists(path):
+                roots.add(os.path.dirname(path))
+
+        # The whole directory is updated, its date depends on the other images in it as well. Changing a file doesn't
+        # change the mtime of its directory, so it's listed whether the scanner thinks it has changed or not
+        for root in roots:
+            try:
+                stat, dirs, files = list_directory(root, None, self.is_image)
+            except OSError:
+                continue
+            self.update_dir(root, files)
+            self.done(ScannedDirectory(root, stat, dirs, files))
+
+        self.commit()
+
+    def done(self, directory):
+        # Remember the directory with the mtime it was given, otherwise it would be listed again on the next run
+        try:
+            self.scanner.done(directory, os.stat(directory.path))
+        except OSError:
+            pass
+
+    def commit(self):
+        if self.connection:
+            self.connection.commit()
+        if self.media:
+            self.media.commit()
+
+    def is_own_change(self, path):
+        with self.lock:
+            date = self.own_changes.pop(path, None) if self.own_changes is not None else None
+        if date is None:
+            return False
+        try:
+            return int(os.stat(path).st_mtime) == date
+        except OSError:
+            return False
+
+    def update_utime(self, path, date, current=None):
+        # The file may have been removed since it was read, or not be writable
+        try:
+            current = current or os.stat(path)
+        except OSError as e:
+            print ("Error setting %s: %s" % (path, e))
+            return
+
         if int(current.st_mtime) != date:
             print ("Setting %s to %s" % (path, date))
-            os.utime(path, (date, date))
+            with self.lock:
+                if self.own_changes is not None:
+                    self.own_changes[path] = date
+            try:
+                os.utime(path, (date, date))
+            except OSError as e:
+                with self.lock:
+                    if self.own_changes is not None:
+                        self.own_changes.pop(path, None)
+                print ("Error setting %s: %s" % (path, e))
         else:
             pass
             #print ("Already correct for %s " % path)
@@ -87,8 +339,15 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Updates files modified time to date saved in the EXIF data")
     parser.add_argument("--source", required=True, help="The source folder to read from")
     parser.add_argument('--timezone', required=True, help="The timezone to use")
+    parser.add_argument('--workers', type=int, default=1, help="Amount of files to read and update at the same time, a few more than one helps on network storage")
+    parser.add_argument('--watch', action="store_true", default=False, help="Keeps running after the first traversal and updates new and changed images right away")
+    parser.add_argument('--settle', type=float, default=2.0, help="Seconds without changes to wait for before updating when watching")
+    parser.add_argument('--media-index', help="File to share the dimensions and dates read from the images in with directory_thumbnails.py, so every image is only parsed by one of them")
+    parser.add_argument('--cache', help="File to remember the checked folders and the dates of the files in, folders that haven't changed since are skipped and files that haven't changed aren't read again on the next run")
 
     args = parser.parse_args()
 
-    directory = ExifDirectory(args.source, args.timezone)
+    directory = ExifDirectory(args.source, args.timezone, args.cache, args.workers, MediaIndex(args.media_index) if args.media_index else None)
     directory.update()
+    if args.watch:
+        directory.watch(args.settle)
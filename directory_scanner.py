@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import os
+from collections import deque
+
+# Can't be part of a file name, so it's safe for joining the names of the subdirectories
+SUBDIR_SEPARATOR = '/'
+SCAN_LOOKAHEAD = 16
+
+
+class ScannedDirectory:
+    def __init__(self, path, stat, dirs, files):
+        self.path = path
+        self.stat = stat
+        self.dirs = dirs
+        self.files = files
+
+
+def list_directory(path, known, stat_file):
+    # Returns no dirs or files when the directory is the same as it was known to be
+    stat = os.stat(path)
+    if known == (stat.st_mtime_ns, stat.st_ctime_ns):
+        return stat, None, None
+
+    dirs = []
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # The type is known from the listing itself on most file systems, so this doesn't need a stat
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif entry.is_file():
+                # The stat is cached in the entry, so it's fetched here when listing in another thread
+                if stat_file is not None and stat_file(entry.name):
+                    try:
+                        entry.stat()
+                    except OSError:
+                        continue
+                files.append(entry)
+    return stat, dirs, files
+
+
+class DirectoryScanner:
+    def __init__(self, connection=None, key='', executor=None, stat_file=None, lookahead=SCAN_LOOKAHEAD):
+        # Without a connection nothing is remembered and every directory is listed
+        self.connection = connection
+        self.key = key
+        self.executor = executor
+        self.stat_file = stat_file
+        self.lookahead = lookahead
+        self.failed = set()
+        if connection is not None:
+            connection.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime INTEGER, ctime INTEGER, subdirs TEXT, key TEXT)")
+
+    def scan(self, top):
+        # The mtime of a directory only changes when entries are added, removed or renamed in it. A directory that
+        # hasn't changed since it was done costs a single stat, only its subdirectories are checked the same way.
+        # With an executor the next directories are listed in other threads while the current one is handled
+        paths = deque([os.path.abspath(top)])
+        listings = deque()
+        while len(paths) > 0 or len(listings) > 0:
+            while len(paths) > 0 and len(listings) < self.lookahead:
+                path = paths.popleft()
+                state = self.state(path)
+                if self.executor is not None:
+                    listing = self.executor.submit(list_directory, path, state[:2] if state else None, self.stat_file)
+                else:
+                    listing = None
+                listings.append((path, state, listing))
+
+            path, state, listing = listings.popleft()
+            try:
+                stat, dirs, files = listing.result() if listing is not None else list_directory(path, state[:2] if state else None, self.stat_file)
+            except OSError as e:
+                print ("Error listing %s: %s" % (path, e))
+                continue
+
+            if dirs is None:
+                paths.extend(os.path.join(path, name) for name in state[2])
+                continue
+
+            self.failed.discard(path)
+            yield ScannedDirectory(path, stat, dirs, files)
+            paths.extend(os.path.join(path, name) for name in dirs)
+
+    def state(self, path):
+        if self.connection is None:
+            return None
+        row = self.connection.execute("SELECT mtime, ctime, subdirs FROM directories WHERE path = ? AND key = ?", (path, self.key)).fetchone()
+        return (row[0], row[1], [name for name in row[2].split(SUBDIR_SEPARATOR) if name]) if row else None
+
+    def done(self, directory, stat=None):
+        # Remember the directory as it was when it was listed, unless something in it failed since then
+        if self.connection is None or directory.path in self.failed:
+            return
+        stat = stat or directory.stat
+        self.connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)", (directory.path, stat.st_mtime_ns, stat.st_ctime_ns, SUBDIR_SEPARATOR.join(directory.dirs), self.key))
+
+    def forget(self, path):
+        # Listed again on the next scan, e.g. when a file in it has to be retried
+        self.failed.add(path)
+        if self.connection is not None:
+            self.connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+
+    def paths(self, top):
+        if self.connection is None:
+            return []
+        top = os.path.abspath(top)
+        rows = self.connection.execute("SELECT path FROM directories WHERE path = ? OR (path >= ? AND path < ?)", (top, top + '/', top + '0'))
+        return [row[0] for row in rows]
@@ -1,39 +1,384 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import io
 import time
 import os
+import re
+import math
 import argparse
-from pgmagick import Image, Blob
+import sqlite3
+import json
+import hashlib
+import heapq
+import threading
+import urllib.parse
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# GraphicsMagick reads its resource limits when it's loaded, beyond them the pixels of large images are cached on disk
+# instead of in memory. Set in the environment to override, the limits are per process
+MAGICK_MEMORY_LIMIT = 256 * 1024 * 1024
+MAGICK_MAP_LIMIT = 512 * 1024 * 1024
+os.environ.setdefault('MAGICK_LIMIT_MEMORY', str(MAGICK_MEMORY_LIMIT))
+os.environ.setdefault('MAGICK_LIMIT_MAP', str(MAGICK_MAP_LIMIT))
+
+# The imaging libraries are only needed for the backend that is used
+try:
+    from pgmagick import Image as PgImage, Blob, Geometry, InterlaceType
+except ImportError:
+    PgImage = None
+
+try:
+    from PIL import Image as PILImage
+    # The pixels decoded are limited by the pixel budget and the size hint instead
+    PILImage.MAX_IMAGE_PIXELS = None
+except ImportError:
+    PILImage = None
+
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from jpeg_header import read_header
+from directory_scanner import DirectoryScanner
+from media_index import MediaIndex
 
 LARGE_MAX_WIDTH = 1280
 LARGE_MAX_HEIGHT = 720
 SMALL_WIDTH_AND_HEIGHT = 100
+INDEX_FILENAME = '.thumbnails.db'
+INDEX_VERSION = 5
+INDEX_COMMIT_INTERVAL = 100
+CACHE_FILENAME = '.thumbnails-cache.db'
+MANIFEST_FILENAME = 'manifest.json'
+CACHE_SIZE_MB = 1024
+CACHE_USED_RESOLUTION = 60
+MAX_PENDING_PATHS = 100000
+PREVIEW_MAX_ASPECT_DIFFERENCE = 0.02
+BACKFILL_BATCH = 20
+PARTIAL_HASH_SIZE = 65536
+PIXEL_BUDGET_MEGAPIXELS = 100
+WALK_THREADS = 4
+
+# The format written by GraphicsMagick and the extension of the thumb, None keeps the name of the image
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', None),
+    'pjpeg': ('JPEG', None),
+    'webp': ('WEBP', '.webp')
+}
+
+METRICS_PREFIX = 'directory_thumbnails'
+METRICS_EXPORT_INTERVAL = 10
+METRICS = {
+    'generated_total': ('counter', "Images that thumbs have been generated for"),
+    'linked_total': ('counter', "Images that got the thumbs of an identical image linked instead"),
+    'failed_total': ('counter', "Images that thumbs couldn't be generated for"),
+    'stage_seconds_total': ('counter', "Seconds spent in every stage, walk, check and dedupe in the main process and the rest in the workers"),
+    'jobs_pending': ('gauge', "Images queued for or being generated by the workers"),
+    'images_pending': ('gauge', "Changed images waiting until they have settled"),
+    'walks_pending': ('gauge', "Directory walks that haven't finished yet"),
+    'pixels_pending': ('gauge', "Estimated pixels decoded by the queued jobs"),
+    'start_time_seconds': ('gauge', "When the process was started in seconds since epoch")
+}
 
 
 class NeedsRescanHandler(FileSystemEventHandler):
-    def __init__(self):
-        self.modifications = False
+    def __init__(self, wakeup=None, is_own_change=None):
+        self.lock = threading.Lock()
+        self.wakeup = wakeup or threading.Event()
+        self.is_own_change = is_own_change
+        self.full_rescan = False
+        self.moves = []
+        self.paths = {}
+
+    def add_path(self, path):
+        # Remember when the path last changed so it can be left alone until it's done being written
+        with self.lock:
+            if not self.is_overflowing_locked():
+                self.paths[path] = time.time()
+        self.wakeup.set()
+
+    def add_move(self, source_path, destination_path):
+        with self.lock:
+            if not self.is_overflowing_locked():
+                # The thumbs are moved along with the image, the destination is still checked in case it was replaced or changed
+                self.moves.append((source_path, destination_path))
+                self.paths[destination_path] = time.time()
+        self.wakeup.set()
+
+    def is_overflowing_locked(self):
+        # Watchdog doesn't tell us when inotify drops events, so treat a runaway work set the same way and walk everything instead
+        if not self.full_rescan and len(self.moves) + len(self.paths) >= MAX_PENDING_PATHS:
+            self.rescan_locked()
+        return self.full_rescan
+
+    def rescan(self):
+        with self.lock:
+            self.rescan_locked()
+        self.wakeup.set()
+
+    def rescan_locked(self):
+        self.full_rescan = True
+        self.moves = []
+        self.paths = {}
+
+    def take_changes(self):
+        with self.lock:
+            changes = (self.full_rescan, self.moves, self.paths)
+            self.full_rescan = False
+            self.moves = []
+            self.paths = {}
+        return changes
+
+    def on_created(self, event):
+        self.add_path(event.src_path)
 
     def on_modified(self, event):
-        self.modifications = True
+        # Setting the mtime when fixing it is a modification as well, those are ignored. Checked for directories too so they are forgotten
+        own_change = self.is_own_change is not None and self.is_own_change(event.src_path)
+        # A directory is modified whenever its content changes, the content has its own events
+        if not event.is_directory and not own_change:
+            self.add_path(event.src_path)
 
     def on_moved(self, event):
-        self.modifications = True
+        self.add_move(event.src_path, event.dest_path)
 
+    def on_deleted(self, event):
+        self.add_path(event.src_path)
 
-class ThumbnailGenerator:
+
+class ThumbnailProfile:
+    def __init__(self, name, width, height, crop, output_format=None, quality=None):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.crop = crop
+        self.output_format = output_format
+        self.quality = quality
+
+    def __str__(self):
+        # Also used in the index, so a thumb is generated again when its profile changes
+        value = "%s:%sx%s:%s" % (self.name, self.width, self.height, "crop" if self.crop else "fit")
+        if self.output_format:
+            value += ":" + self.output_format
+        if self.quality:
+            value += ":%s" % self.quality
+        return value
+
+    def thumb_name(self, file):
+        if self.output_format is None or OUTPUT_FORMATS[self.output_format][1] is None:
+            return file
+        # The extension is added instead of replaced, IMG_1.jpg and IMG_1.JPG would otherwise share a thumb
+        return file + OUTPUT_FORMATS[self.output_format][1]
+
+    def sample_size(self, width, height, orientation):
+        # Never a zero dimension, neither from a broken header nor from rounding an extreme aspect ratio
+        width, height = max(1, width), max(1, height)
+        if not self.crop:
+            # Limit the width first and only then the height, the same way the large thumbnail always has been
+            if width > self.width:
+                return self.width, max(1, int((float(height) / width) * self.width))
+            elif height > self.height:
+                return max(1, int((float(width) / height) * self.height)), self.height
+            return width, height
+
+        # The crop is made after rotating, so compare the box with the rotated dimensions and scale so the box is covered,
+        # but never larger than the image itself since a very narrow image would otherwise be enlarged many times over
+        rotated_width, rotated_height = (height, width) if orientation in (6, 8) else (width, height)
+        scale = min(1.0, max(float(self.width) / rotated_width, float(self.height) / rotated_height))
+        return max(1, int(math.ceil(width * scale))), max(1, int(math.ceil(height * scale)))
+
+
+def parse_profile(value):
+    m = re.match('^([A-Za-z0-9_-]+):([0-9]+)x([0-9]+)(?::(fit|crop))?(?::(%s)(?::([0-9]+))?)?$' % '|'.join(OUTPUT_FORMATS), value)
+    if not m:
+        raise argparse.ArgumentTypeError("Invalid profile %s, expected NAME:WIDTHxHEIGHT[:fit|crop[:%s[:QUALITY]]]" % (value, '|'.join(OUTPUT_FORMATS)))
+    if int(m.group(2)) < 1 or int(m.group(3)) < 1:
+        raise argparse.ArgumentTypeError("Invalid size in profile %s, the width and height must be at least 1" % value)
+    if m.group(6) and not 1 <= int(m.group(6)) <= 100:
+        raise argparse.ArgumentTypeError("Invalid quality in profile %s, expected 1-100" % value)
+    return ThumbnailProfile(m.group(1), int(m.group(2)), int(m.group(3)), m.group(4) == 'crop', m.group(5), int(m.group(6)) if m.group(6) else None)
+
+
+def partial_hash(path, size):
+    # Only the size and both ends of the file, enough to find possible duplicates without reading everything
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(PARTIAL_HASH_SIZE))
+        if size > PARTIAL_HASH_SIZE:
+            f.seek(max(PARTIAL_HASH_SIZE, size - PARTIAL_HASH_SIZE))
+            digest.update(f.read(PARTIAL_HASH_SIZE))
+    return digest.hexdigest()
+
+
+def content_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_info(width, height, orientation, header):
+    # What the manifests tell about an image, the thumbs are added as (width, height, bytes) per profile
+    date = header.datetime_original or header.datetime
+    return {
+        'width': width,
+        'height': height,
+        'orientation': orientation or 1,
+        'date': date[:10].replace(':', '-') + date[10:] if date else None,
+        'thumbs': {}
+    }
+
+
+def merge_info(info, new_info):
+    # Keep what is known about the thumbs that weren't made again
+    if info is None or new_info is None:
+        return new_info or info
+    return dict(new_info, thumbs=dict(info['thumbs'], **new_info['thumbs']))
+
+
+def remove_empty_dirs(path, top_path):
+    # Remove the directory and its parents until one of them still has content
+    while path.startswith(top_path + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+        path = os.path.dirname(path)
+
+
+DEFAULT_PROFILES = [
+    ThumbnailProfile('large', LARGE_MAX_WIDTH, LARGE_MAX_HEIGHT, False),
+    ThumbnailProfile('small', SMALL_WIDTH_AND_HEIGHT, SMALL_WIDTH_AND_HEIGHT, True)
+]
+
+
+class StageTimer:
     def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[stage] = self.durations.get(stage, 0.0) + time.perf_counter() - start
+
+
+class ThumbnailMetrics:
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.values = {}
+        self.next_export = 0
+        self.set('start_time_seconds', time.time())
+        for name in ('generated_total', 'linked_total', 'failed_total'):
+            self.set(name, 0)
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def add_durations(self, durations):
+        for stage, seconds in durations.items():
+            self.add('stage_seconds_total', seconds, stage=stage)
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add('stage_seconds_total', time.perf_counter() - start, stage=stage)
+
+    def render(self):
+        # Prometheus text format, the throughput is the rate of the generated counter
+        with self.lock:
+            values = sorted(self.values.items())
+
+        lines = []
+        for name, (kind, description) in sorted(METRICS.items()):
+            lines.append("# HELP %s_%s %s" % (METRICS_PREFIX, name, description))
+            lines.append("# TYPE %s_%s %s" % (METRICS_PREFIX, name, kind))
+            for (key, labels), value in values:
+                if key == name:
+                    label_text = "{%s}" % ",".join('%s="%s"' % label for label in labels) if len(labels) > 0 else ""
+                    lines.append("%s_%s%s %r" % (METRICS_PREFIX, name, label_text, float(value)))
+        return "\n".join(lines) + "\n"
+
+    def export(self, force=False):
+        if self.path is None or (not force and time.time() < self.next_export):
+            return
+        self.next_export = time.time() + METRICS_EXPORT_INTERVAL
+
+        # Replace the file so the textfile collector never reads it half written
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(self.render())
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            print ("Error writing metrics to %s: %s" % (self.path, e))
+
+    def serve(self, host, port):
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        server.metrics = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print ("Serving metrics on http://%s:%s/metrics" % (host, port))
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be logged every few seconds
         pass
 
-    def generate(self, source_path, small_thumb_path, large_thumb_path):
-        img = Image(source_path)
 
-        width = img.size().width()
-        height = img.size().height()
+class PgmagickBackend:
+    name = 'pgmagick'
+    # Raised for images that can't be read, in addition to the errors of every backend
+    errors = (RuntimeError,)
 
+    def __init__(self):
+        if PgImage is None:
+            raise RuntimeError("pgmagick is not installed")
+
+    def load(self, source_path, width=None, height=None):
+        if width is None:
+            return PgImage(source_path)
+
+        # The JPEG decoder scales by 1/2, 1/4 or 1/8 while decoding as long as the result still covers the size
+        img = PgImage()
+        img.size(Geometry(width, height))
+        img.read(source_path)
+        return img
+
+    def load_data(self, data):
+        return PgImage(Blob(data))
+
+    def size(self, img):
+        return img.size().width(), img.size().height()
+
+    def orientation(self, img):
         # Detect if we need to rotate the image by reading EXIF data
         orientation = 0
         if img.attribute("EXIF:Orientation") != "unknown":
@@ -41,113 +386,1213 @@ class ThumbnailGenerator:
                 orientation = int(img.attribute("EXIF:Orientation"))
             except ValueError:
                 print ("Invalid EXIF orientation, using default")
+        return orientation
 
-        # Strip exif data
+    def strip(self, img):
         blob = Blob()
         img.profile("*", blob)
+        return img
+
+    # Copying an image is cheap, the pixels are only copied once the copy is changed
+
+    def resize(self, img, width, height):
+        img = PgImage(img)
+        img.sample("!%sx%s" % (width, height))
+        return img
+
+    def rotate(self, img, degrees):
+        img = PgImage(img)
+        img.rotate(degrees)
+        return img
+
+    def crop(self, img, width, height):
+        img = PgImage(img)
+        img.crop("%sx%s" % (width, height))
+        return img
+
+    def encode(self, img, output_format, quality):
+        # Without a format the thumb is written the same way as the image was read
+        img = PgImage(img)
+        if output_format is not None:
+            img.magick(OUTPUT_FORMATS[output_format][0])
+        if output_format == 'pjpeg':
+            img.interlaceType(InterlaceType.LineInterlace)
+        if quality is not None:
+            img.quality(quality)
+
+        data = Blob()
+        img.write(data)
+        return data.data
+
+
+class PillowBackend:
+    name = 'pillow'
+    errors = (ValueError, ZeroDivisionError, SyntaxError, EOFError, IndexError)
+
+    def __init__(self):
+        if PILImage is None:
+            raise RuntimeError("Pillow is not installed")
+
+    def load(self, source_path, width=None, height=None):
+        img = PILImage.open(source_path)
+        # Like the size hint of pgmagick, the JPEG decoder picks the smallest scale that still covers the size
+        if width is not None:
+            img.draft('RGB', (width, height))
+        # Decode right away instead of on first use so the time is measured as decoding
+        img.load()
+        return img
+
+    def load_data(self, data):
+        return PILImage.open(io.BytesIO(data))
 
-        # Detect if we need to resize the large thumbnail
-        if width > LARGE_MAX_WIDTH:
-            height = int((float(height) / width) * LARGE_MAX_WIDTH)
-            width = LARGE_MAX_WIDTH
-        elif height > LARGE_MAX_HEIGHT:
-            width = int((float(width) / height) * LARGE_MAX_HEIGHT)
-            height = LARGE_MAX_HEIGHT
+    def size(self, img):
+        return img.size
 
-        # Rescale the large thumbnail if dimensions doesn't match
-        if width != img.size().width() or height != img.size().height():
-            img.sample("!%sx%s" % (width, height))
+    def orientation(self, img):
+        return img.getexif().get(0x0112, 0)
 
-        # Rotate the image if needed
-        if orientation == 6:
-            img.rotate(90)
-        elif orientation == 8:
-            img.rotate(-90)
-        elif orientation == 3:
-            img.rotate(180)
+    def strip(self, img):
+        # Nothing is kept unless it's given when saving
+        return img
 
-        self.write_image(img, large_thumb_path)
+    def resize(self, img, width, height):
+        return img.resize((width, height), PILImage.LANCZOS, reducing_gap=3.0)
 
-        # Crop the small thumbnail and then resize it to the correct size
-        img.crop("%sx%s" % (min(width, height), min(width, height)))
-        img.sample("%sx%s" % (SMALL_WIDTH_AND_HEIGHT, SMALL_WIDTH_AND_HEIGHT))
+    def rotate(self, img, degrees):
+        # Transposing is counter clockwise while rotating in GraphicsMagick is clockwise
+        return img.transpose({90: PILImage.ROTATE_270, -90: PILImage.ROTATE_90, 180: PILImage.ROTATE_180}[degrees])
 
-        self.write_image(img, small_thumb_path)
+    def crop(self, img, width, height):
+        return img.crop((0, 0, min(width, img.size[0]), min(height, img.size[1])))
 
-    def write_image(self, img, path):
+    def encode(self, img, output_format, quality):
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        data = io.BytesIO()
+        options = {'quality': quality} if quality is not None else {}
+        img.save(data, OUTPUT_FORMATS[output_format or 'jpeg'][0], progressive=output_format == 'pjpeg', **options)
+        return data.getvalue()
+
+
+BACKENDS = {backend.name: backend for backend in [PgmagickBackend, PillowBackend]}
+
+
+class ThumbnailGenerator:
+    def __init__(self, profiles, size_hint=True, exif_preview=False, backend=None):
+        # Largest first so every profile can be sampled from the closest larger intermediate instead of the original
+        self.profiles = sorted(profiles, key=lambda p: p.width * p.height, reverse=True)
+        self.size_hint = size_hint
+        self.exif_preview = exif_preview
+        self.backend = backend or PgmagickBackend()
+        # What a single bad image can raise, so it fails on its own instead of stopping everything
+        self.errors = (RuntimeError, OSError, MemoryError) + self.backend.errors
+
+    def generate(self, source_path, thumb_paths, header=None):
+        # Returns the seconds spent in every stage so it can be reported from the worker processes, and what
+        # was found out about the image and its thumbs on the way for the manifests
+        timer = StageTimer()
+        profiles = [profile for profile in self.profiles if profile.name in thumb_paths]
+
+        with timer.measure('decode'):
+            # A header from the media index doesn't have the preview
+            if header is None or (self.exif_preview and header.thumbnail is None):
+                header = read_header(source_path, self.exif_preview)
+            preview = self.load_preview(header, profiles) if self.exif_preview else None
+
+            # The preview doesn't have any EXIF data of its own, so the orientation of the main image is used
+            if preview is not None:
+                img = preview
+                orientation = header.orientation or 0
+            else:
+                img = self.load_image(source_path, header, profiles)
+                orientation = self.backend.orientation(img)
+
+            width, height = self.backend.size(img)
+
+            # Strip exif data
+            img = self.backend.strip(img)
+
+        # The decoded size may be scaled down by the size hint, the header has the real one
+        info = image_info(header.width or width, header.height or height, orientation, header)
+
+        intermediates = [img]
+        for profile in profiles:
+            sample_width, sample_height = profile.sample_size(width, height, orientation)
+
+            # Rescale from the smallest image that is still large enough if dimensions doesn't match
+            sizes = [(self.backend.size(i), i) for i in intermediates]
+            thumb = min([s for s in sizes if s[0][0] >= sample_width and s[0][1] >= sample_height] or [sizes[0]], key=lambda s: s[0][0])[1]
+            with timer.measure('sample'):
+                if (sample_width, sample_height) != self.backend.size(thumb):
+                    thumb = self.backend.resize(thumb, sample_width, sample_height)
+                    intermediates.append(thumb)
+
+            # Rotate the image if needed
+            with timer.measure('rotate'):
+                if orientation == 6:
+                    thumb = self.backend.rotate(thumb, 90)
+                elif orientation == 8:
+                    thumb = self.backend.rotate(thumb, -90)
+                elif orientation == 3:
+                    thumb = self.backend.rotate(thumb, 180)
+
+            # Crop the thumbnail from the top left corner to the size of the box
+            with timer.measure('sample'):
+                if profile.crop:
+                    thumb = self.backend.crop(thumb, profile.width, profile.height)
+
+            with timer.measure('encode'):
+                data = self.backend.encode(thumb, profile.output_format, profile.quality)
+
+            with timer.measure('write'):
+                self.write_image(data, thumb_paths[profile.name])
+
+            info['thumbs'][profile.name] = self.backend.size(thumb) + (len(data),)
+
+        return timer.durations, info
+
+    def load_preview(self, header, profiles):
+        if header.thumbnail is None or not header.width or not header.height:
+            return None
+
+        preview = self.backend.load_data(header.thumbnail)
+        preview_width, preview_height = self.backend.size(preview)
+
+        # Some cameras pad the preview with black bars to a fixed aspect ratio, those can't be used
+        aspect = float(header.width) / header.height
+        if abs(float(preview_width) / preview_height - aspect) > aspect * PREVIEW_MAX_ASPECT_DIFFERENCE:
+            return None
+
+        # Every profile must be possible to make from the preview without enlarging it
+        for profile in profiles:
+            sample_width, sample_height = profile.sample_size(header.width, header.height, header.orientation or 0)
+            if sample_width > preview_width or sample_height > preview_height:
+                return None
+
+        return preview
+
+    def load_image(self, source_path, header, profiles):
+        if not self.size_hint or not header.width or not header.height:
+            return self.backend.load(source_path)
+
+        # Use the dimensions from the header and tell the decoder the size we need
+        return self.backend.load(source_path, *self.hint_size(header, profiles))
+
+    def hint_size(self, header, profiles):
+        sizes = [profile.sample_size(header.width, header.height, header.orientation or 0) for profile in profiles]
+        return max(size[0] for size in sizes), max(size[1] for size in sizes)
+
+    def source_header(self, source_path):
+        # The header as generate needs it, None when it can't be read
+        try:
+            return read_header(source_path, self.exif_preview)
+        except OSError:
+            return None
+
+    def image_pixels(self, source_path, thumb_paths, header, budget):
+        # An image without known dimensions is treated as using the whole budget and is decoded on its own
+        pixels = self.decode_pixels(source_path, thumb_paths, header)
+        return pixels if pixels is not None else budget.limit
+
+    def decode_pixels(self, source_path, thumb_paths, header=None):
+        # Estimate of the pixels in memory while decoding, None when the dimensions aren't in the header
+        header = header or self.source_header(source_path)
+        if header is None or not header.width or not header.height:
+            return None
+        if not self.size_hint:
+            return header.width * header.height
+
+        profiles = [profile for profile in self.profiles if profile.name in thumb_paths]
+        width, height = self.hint_size(header, profiles)
+        scale = 1
+        while scale < 8 and header.width // (scale * 2) >= width and header.height // (scale * 2) >= height:
+            scale *= 2
+        return int(math.ceil(float(header.width) / scale) * math.ceil(float(header.height) / scale))
+
+    def write_image(self, data, path):
         # Create the directory tree and then write the image
         if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
-        img.write(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Replace instead of writing in place, the old file might be hardlinked to the thumb of a duplicate image
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+
+class PixelBudget:
+    # The pixels decoded at the same time, shared by the jobs and the thumbs generated on request. An image larger than the
+    # whole budget is still decoded once nothing else is
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def available(self, pixels):
+        return self.used == 0 or self.used + pixels <= self.limit
+
+    def try_acquire(self, pixels):
+        with self.condition:
+            if not self.available(pixels):
+                return False
+            self.used += pixels
+            return True
+
+    def acquire(self, pixels):
+        with self.condition:
+            self.condition.wait_for(lambda: self.available(pixels))
+            self.used += pixels
+
+    def release(self, pixels):
+        with self.condition:
+            self.used -= pixels
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserved(self, pixels):
+        self.acquire(pixels)
+        try:
+            yield
+        finally:
+            self.release(pixels)
+
+
+class ThumbnailJobs:
+    def __init__(self, generator, workers, metrics=None, pixel_budget=PIXEL_BUDGET_MEGAPIXELS * 1000000):
+        self.generator = generator
+        self.workers = workers
+        self.metrics = metrics or ThumbnailMetrics()
+        self.budget = PixelBudget(pixel_budget)
+        self.pending = deque()
+        self.executor = self.create_executor()
+
+    def create_executor(self):
+        return ProcessPoolExecutor(self.workers) if self.workers > 1 else None
+
+    def submit(self, relative_path, on_generated, source_path, thumb_paths, on_failed=None, header=None):
+        # Parsed once here and passed on, so the worker doesn't parse it again
+        header = header or self.generator.source_header(source_path)
+        pixels = self.generator.image_pixels(source_path, thumb_paths, header, self.budget)
+
+        if self.executor is None:
+            try:
+                with self.budget.reserved(pixels):
+                    durations, info = self.generator.generate(source_path, thumb_paths, header)
+                self.generated(relative_path, on_generated, durations, info)
+            except self.generator.errors as e:
+                self.failed(relative_path, on_failed, e)
+            return
+
+        # Keep the amount of queued work bounded so a large initial walk doesn't fill up the memory, and the pixels
+        # decoded at the same time within the budget. An image larger than the budget still runs once nothing else does
+        while True:
+            if len(self.pending) < self.workers * 2 and self.budget.try_acquire(pixels):
+                break
+            if len(self.pending) == 0:
+                # Only thumbs generated on request are using the budget, they are done soon
+                self.budget.acquire(pixels)
+                break
+            self.complete_next()
+
+        future = self.executor.submit(self.generator.generate, source_path, thumb_paths, header)
+        self.pending.append((relative_path, on_generated, on_failed, future, pixels))
+
+    def pending_pixels(self):
+        return sum(job[4] for job in self.pending)
+
+    def complete_next(self):
+        # Always wait for the oldest job so the progress is logged in the order the files were found
+        relative_path, on_generated, on_failed, future, pixels = self.pending.popleft()
+        try:
+            durations, info = future.result()
+            self.budget.release(pixels)
+            self.generated(relative_path, on_generated, durations, info)
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed for using too much memory) and took the queued jobs with it, they will be retried on the next scan
+            self.budget.release(pixels)
+            self.failed(relative_path, on_failed, e)
+            while len(self.pending) > 0:
+                job = self.pending.popleft()
+                self.budget.release(job[4])
+                self.failed(job[0], job[2], e)
+            self.executor.shutdown(wait=False)
+            self.executor = self.create_executor()
+        except self.generator.errors as e:
+            self.budget.release(pixels)
+            self.failed(relative_path, on_failed, e)
+
+    def wait(self):
+        while len(self.pending) > 0:
+            self.complete_next()
+
+    def generated(self, relative_path, on_generated, durations, info):
+        on_generated(info)
+        self.metrics.add_durations(durations)
+        self.metrics.add('generated_total')
+        print ("Generated thumbs for %s" % relative_path)
+
+    def failed(self, relative_path, on_failed, e):
+        if on_failed is not None:
+            on_failed()
+        self.metrics.add('failed_total')
+        print ("Error generating thumbs for %s: %s" % (relative_path, e))
+
+
+class ThumbnailIndex:
+    def __init__(self, target_path):
+        if not os.path.exists(target_path):
+            os.makedirs(target_path)
+        self.connection = sqlite3.connect(os.path.join(target_path, INDEX_FILENAME))
+        self.pending = 0
+        self.changed_dirs = set()
+
+        # The index is only a cache of what exists on disk, so recreate it if the layout has changed
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS thumbnails")
+            self.connection.execute("DROP TABLE IF EXISTS directories")
+            self.connection.execute("CREATE TABLE thumbnails (source TEXT, relative_path TEXT, size INTEGER, mtime INTEGER, thumbs TEXT, partial_hash TEXT, content_hash TEXT, info TEXT, PRIMARY KEY (source, relative_path))")
+            self.connection.execute("CREATE INDEX thumbnails_partial_hash ON thumbnails (partial_hash)")
+            self.connection.execute("PRAGMA user_version = %d" % INDEX_VERSION)
+            self.connection.commit()
+
+    def entries(self, source_path, relative_dir=None):
+        if relative_dir is None:
+            rows = self.connection.execute("SELECT relative_path, size, mtime, thumbs, info FROM thumbnails WHERE source = ?", (source_path,))
+        else:
+            # Everything below the directory sorts between "dir/" and "dir0" since '0' comes right after '/'
+            rows = self.connection.execute("SELECT relative_path, size, mtime, thumbs, info FROM thumbnails WHERE source = ? AND relative_path >= ? AND relative_path < ?", (source_path, relative_dir + '/', relative_dir + '0'))
+        return {row[0]: (row[1], row[2], self.thumbs(row[3]), self.info(row[4])) for row in rows}
+
+    def entry(self, source_path, relative_path):
+        row = self.connection.execute("SELECT size, mtime, thumbs, info FROM thumbnails WHERE source = ? AND relative_path = ?", (source_path, relative_path)).fetchone()
+        return (row[0], row[1], self.thumbs(row[2]), self.info(row[3])) if row else None
+
+    def directory(self, relative_dir):
+        # The images directly in the directory from every source
+        if relative_dir == '':
+            rows = self.connection.execute("SELECT source, relative_path, size, thumbs, info FROM thumbnails WHERE relative_path NOT LIKE '%/%'")
+        else:
+            rows = self.connection.execute("SELECT source, relative_path, size, thumbs, info FROM thumbnails WHERE relative_path >= ? AND relative_path < ?", (relative_dir + '/', relative_dir + '0'))
+        return [(row[0], row[1], row[2], self.thumbs(row[3]), self.info(row[4])) for row in rows if os.path.dirname(row[1]) == relative_dir]
+
+    def thumbs(self, value):
+        return tuple(name for name in value.split(',') if name)
+
+    def info(self, value):
+        return json.loads(value) if value else None
+
+    def duplicates(self, partial_hash):
+        rows = self.connection.execute("SELECT source, relative_path, size, mtime, thumbs, content_hash, info FROM thumbnails WHERE partial_hash = ?", (partial_hash,))
+        return [(row[0], row[1], row[2], row[3], self.thumbs(row[4]), row[5], self.info(row[6])) for row in rows]
+
+    def record(self, source_path, relative_path, size, mtime, thumbs, partial_hash=None, content_hash=None, info=None):
+        self.connection.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (source_path, relative_path, size, mtime, ','.join(thumbs), partial_hash, content_hash, json.dumps(info) if info else None))
+        self.changed_dirs.add(os.path.dirname(relative_path))
+        self.changed()
+
+    def record_content_hash(self, source_path, relative_path, content_hash):
+        self.connection.execute("UPDATE thumbnails SET content_hash = ? WHERE source = ? AND relative_path = ?", (content_hash, source_path, relative_path))
+        self.changed()
+
+    def move(self, source_path, relative_path, new_relative_path, thumbs):
+        self.connection.execute("DELETE FROM thumbnails WHERE source = ? AND relative_path = ?", (source_path, new_relative_path))
+        self.connection.execute("UPDATE thumbnails SET relative_path = ?, thumbs = ? WHERE source = ? AND relative_path = ?", (new_relative_path, ','.join(thumbs), source_path, relative_path))
+        self.changed_dirs.update([os.path.dirname(relative_path), os.path.dirname(new_relative_path)])
+        self.changed()
+
+    def remove(self, source_path, relative_path):
+        self.connection.execute("DELETE FROM thumbnails WHERE source = ? AND relative_path = ?", (source_path, relative_path))
+        self.changed_dirs.add(os.path.dirname(relative_path))
+        self.changed()
+
+    def take_changed_dirs(self):
+        changed_dirs = self.changed_dirs
+        self.changed_dirs = set()
+        return changed_dirs
+
+    def changed(self):
+        self.pending += 1
+        if self.pending >= INDEX_COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+
+class ThumbnailCache:
+    def __init__(self, target_path, max_bytes):
+        # Only thumbs generated on request are in the cache, so it's separate from the index and shared between the request threads
+        self.target_path = os.path.abspath(target_path)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(self.target_path, CACHE_FILENAME), check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache (path TEXT PRIMARY KEY, size INTEGER, used REAL)")
+        self.connection.commit()
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def used(self, path):
+        # Only written now and then, the order only has to be roughly right
+        now = time.time()
+        with self.lock:
+            if self.connection.execute("UPDATE cache SET used = ? WHERE path = ? AND used < ?", (now, path, now - CACHE_USED_RESOLUTION)).rowcount > 0:
+                self.connection.commit()
+
+    def add(self, path, size):
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM cache WHERE path = ?", (path,)).fetchone()
+            self.size += size - (row[0] if row else 0)
+            self.connection.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (path, size, time.time()))
+            self.evict()
+            self.connection.commit()
+
+    def remove(self, path):
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM cache WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+                self.connection.execute("DELETE FROM cache WHERE path = ?", (path,))
+                self.connection.commit()
+
+    def evict(self):
+        # Remove the least recently used thumbs until the cache fits again, the newest one is always kept
+        while self.size > self.max_bytes:
+            rows = self.connection.execute("SELECT path, size FROM cache ORDER BY used LIMIT 2").fetchall()
+            if len(rows) < 2:
+                break
+            path, size = rows[0]
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            remove_empty_dirs(os.path.dirname(path), self.target_path)
+            self.connection.execute("DELETE FROM cache WHERE path = ?", (path,))
+            self.size -= size
+            print ("Evicted %s from the cache" % path)
 
 
 class CompositeThumbnailDirectory:
-    def __init__(self, source_paths):
-        self.thumbs = [ThumbnailDirectory(source_path, args.target) for source_path in source_paths]
+    def __init__(self, source_paths, target_path, profiles, dedupe=False, metrics=None, eager_days=None, walk_threads=WALK_THREADS, media=None, fix_mtime=None, cache_bytes=None):
+        self.target_path = os.path.abspath(target_path)
+        self.index = ThumbnailIndex(self.target_path)
+        self.cache = ThumbnailCache(self.target_path, cache_bytes) if cache_bytes is not None else None
+        self.media = media
+        self.profiles = profiles
+        self.wakeup = threading.Event()
+
+        # Directories are listed by a pool shared by every source, since the walks are advanced in turns they get an equal share of it
+        executor = ThreadPoolExecutor(walk_threads) if walk_threads > 1 else None
+        self.thumbs = [ThumbnailDirectory(source_path, self.target_path, self.index, profiles, self.wakeup, dedupe, metrics, eager_days, executor, media, self.exif_directory(source_path, fix_mtime, media), self.cache) for source_path in source_paths]
+
+    def exif_directory(self, source_path, timezone_name, media):
+        # Only imported when fixing the mtimes, it needs the dependencies of directory_exif_mtime.py
+        if timezone_name is None:
+            return None
+        from directory_exif_mtime import ExifDirectory
+        return ExifDirectory(source_path, timezone_name, media=media)
 
     def observe(self, observer):
         for thumb in self.thumbs:
             thumb.observe(observer)
 
-    def update(self, generator):
+    def rescan(self):
         for thumb in self.thumbs:
-            thumb.update(generator)
+            thumb.rescan()
 
-    def needs_update(self):
-        result = False
+    def has_events(self):
+        return self.wakeup.is_set()
+
+    def wait(self, timeout):
+        self.wakeup.wait(timeout)
+
+    def collect(self, jobs, settle):
+        # Clear before collecting so events arriving while collecting will wake up the next wait
+        self.wakeup.clear()
+        for thumb in self.thumbs:
+            thumb.collect(jobs, settle)
+
+    def settled(self, settle):
+        # Newest images first so a fresh upload shows up quickly even while a large import is being handled
+        settled = []
         for thumb in self.thumbs:
-            result = result or thumb.needs_update()
+            settled.extend(thumb.settled(settle))
+        return sorted(settled, key=lambda s: s[0], reverse=True)
 
+    def fix_mtimes(self, settled):
+        for thumb in self.thumbs:
+            thumb.fix_mtimes([relative_path for mtime, settled_thumb, relative_path in settled if settled_thumb is thumb])
+
+    def next_due(self):
+        due = [thumb.next_due() for thumb in self.thumbs if thumb.next_due() is not None]
+        return min(due) if len(due) > 0 else None
+
+    def backfill(self, jobs, count):
+        result = False
+        for thumb in self.thumbs:
+            result = thumb.backfill(jobs, count) or result
         return result
 
+    def pending(self):
+        # Amount of images waiting to settle and walks not yet finished
+        return sum(len(thumb.pending) for thumb in self.thumbs), sum(len(thumb.backfills) for thumb in self.thumbs)
+
+    def finish(self, jobs):
+        jobs.wait()
+        self.write_manifests()
+        self.index.commit()
+        if self.media is not None:
+            self.media.commit()
+
+    def write_manifests(self):
+        # Rewrite the manifest of every directory where an image has changed, so a gallery only has to read one file
+        profiles = {profile.name: profile for profile in self.profiles}
+        for relative_dir in self.index.take_changed_dirs():
+            images = {}
+            for source_path, relative_path, size, thumbs, info in self.index.directory(relative_dir):
+                name = os.path.basename(relative_path)
+                if name in images or info is None:
+                    continue
+                image = dict(name=name, size=size, **info)
+                image['thumbs'] = {}
+                for thumb in thumbs:
+                    profile = profiles.get(thumb.split(':')[0])
+                    if profile is not None and profile.name in info['thumbs']:
+                        width, height, thumb_size = info['thumbs'][profile.name]
+                        image['thumbs'][profile.name] = {'name': profile.thumb_name(name), 'width': width, 'height': height, 'size': thumb_size}
+                images[name] = image
+
+            path = os.path.join(self.target_path, relative_dir, MANIFEST_FILENAME)
+            try:
+                if len(images) == 0:
+                    if os.path.exists(path):
+                        os.remove(path)
+                        remove_empty_dirs(os.path.dirname(path), self.target_path)
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump({'images': [images[name] for name in sorted(images)]}, f, separators=(',', ':'))
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                print ("Error writing manifest %s: %s" % (path, e))
+
+    def sweep(self):
+        for thumb in self.thumbs:
+            yield from thumb.sweep()
+
+        # Which source an orphan belongs to isn't known, so nothing is removed while any of them is missing
+        if not all(thumb.is_available() for thumb in self.thumbs):
+            print("Skipping sweep of %s for orphaned thumbs, a source is not available" % self.target_path)
+            return
+
+        print("Sweeping %s for orphaned thumbs" % self.target_path)
+
+        profiles = {profile.name: profile for profile in self.profiles}
+        for root, dirs, files in os.walk(self.target_path):
+            profile = profiles.get(os.path.basename(root))
+            if profile is not None and len(files) > 0:
+                expected = self.expected_thumbs(os.path.relpath(os.path.dirname(root), self.target_path), profile)
+                if expected is None:
+                    print("Skipping sweep of %s, the source could not be listed" % root)
+                    yield
+                    continue
+                for file in files:
+                    if file not in expected:
+                        os.remove(os.path.join(root, file))
+                        print ("Removed orphaned thumb %s" % os.path.join(root, file))
+                remove_empty_dirs(root, self.target_path)
+            yield
+
+    def expected_thumbs(self, relative_dir, profile):
+        # The names of the thumbs for the images in the same directory of every source, None when that can't be known
+        names = set()
+        for thumb in self.thumbs:
+            try:
+                files = os.listdir(os.path.join(thumb.source_path, relative_dir))
+            except FileNotFoundError:
+                # Only a directory that is gone from a source that is still there has no images
+                if not thumb.is_available():
+                    return None
+                continue
+            except OSError:
+                return None
+            names.update(profile.thumb_name(file) for file in files if thumb.is_image(file))
+        return names
+
+
+class WalkedDirectory:
+    # A directory is only remembered as done by the scanner once the walk and every job for its images have completed,
+    # otherwise it would be skipped after a crash while some of its images still don't have thumbs
+    def __init__(self, scanner, directory, stat=None):
+        self.scanner = scanner
+        self.directory = directory
+        self.stat = stat
+        self.remaining = 1
+
+    def started(self):
+        self.remaining += 1
+
+    def completed(self):
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.scanner.done(self.directory, self.stat)
+
 
 class ThumbnailDirectory:
-    def __init__(self, source_path, target_path):
+    def __init__(self, source_path, target_path, index, profiles, wakeup=None, dedupe=False, metrics=None, eager_days=None, executor=None, media=None, exif=None, cache=None):
         self.source_path = os.path.abspath(source_path)
         self.target_path = os.path.abspath(target_path)
-        self.event_handler = NeedsRescanHandler()
+        self.index = index
+        self.media = media
+        self.exif = exif
+        self.cache = cache
+        self.profiles = profiles
+        self.dedupe = dedupe
+        self.metrics = metrics or ThumbnailMetrics()
+        self.eager_days = eager_days
+        if exif is not None:
+            exif.own_changes = {}
+        self.event_handler = NeedsRescanHandler(wakeup, exif.is_own_change if exif is not None else None)
+        # A source that is a mount point when starting must still be one when sweeping, an unmounted share looks empty
+        self.mounted = os.path.ismount(self.source_path)
 
-    def needs_update(self):
-        return self.event_handler.modifications
+        # Directories are skipped while unchanged, until a different set of profiles is used
+        self.scanner = DirectoryScanner(index.connection, ','.join(str(profile) for profile in profiles), executor, self.is_image)
+        self.pending = {}
+        self.due = []
+        self.backfills = deque()
+
+    def rescan(self):
+        self.event_handler.rescan()
 
     def observe(self, observer):
         print("Started observing %s for updates" % self.source_path)
         observer.schedule(self.event_handler, path=self.source_path, recursive=True)
 
-    def small_path(self, relative_path):
-        return os.path.join(self.target_path, os.path.dirname(relative_path), 'small', os.path.basename(relative_path))
+    def thumb_path(self, profile, relative_path):
+        return os.path.join(self.target_path, os.path.dirname(relative_path), profile.name, profile.thumb_name(os.path.basename(relative_path)))
 
-    def large_path(self, relative_path):
-        return os.path.join(self.target_path, os.path.dirname(relative_path), 'large', os.path.basename(relative_path))
+    def existing_thumbs(self, relative_path):
+        return tuple(str(profile) for profile in self.profiles if os.path.exists(self.thumb_path(profile, relative_path)))
 
-    def thumbs_exists(self, relative_path):
-        return os.path.exists(self.small_path(relative_path)) and os.path.exists(self.large_path(relative_path))
+    def thumb_profiles(self, thumbs):
+        # The profiles of the thumbs in the index, matched by name since the thumbs are in the same place even if the profile has changed
+        names = dict((thumb.split(':')[0], thumb) for thumb in thumbs)
+        return [(profile, names[profile.name]) for profile in self.profiles if profile.name in names]
 
     def is_image(self, file):
         return file.lower().endswith('.jpg') or file.lower().endswith('.jpeg')
 
-    def update(self, generator):
-        # Update event handler so it wont be run again if no changes has occured
-        self.event_handler.modifications = False
+    def is_eager(self, mtime):
+        return self.eager_days is None or mtime >= time.time() - self.eager_days * 86400
+
+    def collect(self, jobs, settle):
+        full_rescan, moves, paths = self.event_handler.take_changes()
+
+        if full_rescan:
+            print("Traversing %s for updates" % self.source_path)
+            self.pending = {}
+            self.due = []
+            self.backfills = deque([self.walk(jobs, self.source_path, None)])
+            return
+
+        for source, destination in moves:
+            self.move(source, destination)
+
+        for path, changed in paths.items():
+            relative_path = os.path.relpath(path, self.source_path)
+            if relative_path.startswith(os.pardir):
+                continue
+
+            # Created or moved directories may contain images that never got an event of their own
+            if not os.path.exists(path):
+                self.pending.pop(path, None)
+                self.remove(relative_path)
+            elif os.path.isdir(path):
+                self.backfills.append(self.walk(jobs, path, relative_path))
+            elif self.is_image(path):
+                self.schedule(path, changed + settle, None)
+
+        # Don't let a large import use up the memory, walking everything instead only needs a constant amount
+        if len(self.pending) > MAX_PENDING_PATHS:
+            self.rescan()
+
+    def schedule(self, path, due, signature):
+        self.pending[path] = (due, signature)
+        heapq.heappush(self.due, (due, path))
+
+    def next_due(self):
+        return self.due[0][0] if len(self.due) > 0 else None
+
+    def settled(self, settle):
+        now = time.time()
+        settled = []
+        while len(self.due) > 0 and self.due[0][0] <= now:
+            due, path = heapq.heappop(self.due)
+            # Skip if a later event has moved the path further back
+            if path not in self.pending or self.pending[path][0] != due:
+                continue
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+
+            # Wait until it hasn't been written to for a while, or hasn't changed since last time when the clock is off
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if now - stat.st_mtime < settle and signature != self.pending[path][1]:
+                self.schedule(path, now + settle, signature)
+                continue
+
+            del self.pending[path]
+            settled.append((stat.st_mtime, self, os.path.relpath(path, self.source_path)))
+        return settled
+
+    def backfill(self, jobs, count):
+        # Advance the walks a few images at a time so settled images can be handled in between
+        while len(self.backfills) > 0 and count > 0:
+            if next(self.backfills[0], None) is None:
+                self.backfills.popleft()
+            count -= 1
+        return len(self.backfills) > 0
 
+    def update_all(self, jobs):
         print("Traversing %s for updates" % self.source_path)
 
-        # Go through the whole directory and find image files that doesn't have a thumbnail and then generate them
-        for root, dirs, files in os.walk(self.source_path):
-            for file in files:
-                if self.is_image(file):
-                    absolute_path = os.path.abspath(os.path.join(root, file))
-                    relative_path = os.path.relpath(absolute_path, self.source_path)
-                    if not self.thumbs_exists(relative_path):
-                        try:
-                            generator.generate(
-                                os.path.join(self.source_path, relative_path),
-                                self.small_path(relative_path),
-                                self.large_path(relative_path)
-                            )
-                            print ("Generated thumbs for %s" % relative_path)
-                        except RuntimeError as e:
-                            print ("Error generating thumbs for %s: %s" % (relative_path, e))
+        for relative_path in self.walk(jobs, self.source_path, None):
+            pass
+        jobs.wait()
+        self.index.commit()
+        if self.media is not None:
+            self.media.commit()
+
+    def fix_mtimes(self, relative_paths):
+        # Before the thumbs so they are recorded with the final mtimes, every directory is only updated once
+        if self.exif is not None and len(relative_paths) > 0:
+            self.exif.update_paths([os.path.join(self.source_path, relative_path) for relative_path in relative_paths])
+
+    def update_path(self, jobs, relative_path):
+        self.update_file(jobs, relative_path, self.index.entry(self.source_path, relative_path))
+
+    def indexed(self, relative_path):
+        # The path is either an image or a directory with images in it
+        entry = self.index.entry(self.source_path, relative_path)
+        if entry is not None:
+            return {relative_path: entry}
+        return self.index.entries(self.source_path, relative_path)
+
+    def move(self, source, destination):
+        source_relative_path = os.path.relpath(source, self.source_path)
+        destination_relative_path = os.path.relpath(destination, self.source_path)
+        if source_relative_path.startswith(os.pardir):
+            return
+        if destination_relative_path.startswith(os.pardir):
+            self.remove(source_relative_path)
+            return
+
+        # Rename the thumbs instead of generating them again, whatever couldn't be moved will be generated when the destination is checked
+        for relative_path, entry in self.indexed(source_relative_path).items():
+            new_relative_path = destination_relative_path + relative_path[len(source_relative_path):]
+            moved = []
+            for profile, thumb in self.thumb_profiles(entry[2]):
+                new_thumb_path = self.thumb_path(profile, new_relative_path)
+                try:
+                    os.makedirs(os.path.dirname(new_thumb_path), exist_ok=True)
+                    os.rename(self.thumb_path(profile, relative_path), new_thumb_path)
+                    moved.append(thumb)
+                except OSError as e:
+                    print ("Error moving thumb for %s: %s" % (relative_path, e))
+                remove_empty_dirs(os.path.dirname(self.thumb_path(profile, relative_path)), self.target_path)
+
+            # Thumbs generated on request aren't in the index, they are generated again for the new path when requested
+            self.remove_all_thumbs(relative_path)
+            self.index.move(self.source_path, relative_path, new_relative_path, moved)
+            print ("Moved thumbs for %s to %s" % (relative_path, new_relative_path))
+
+    def remove(self, relative_path):
+        for relative_path, entry in self.indexed(relative_path).items():
+            self.remove_all_thumbs(relative_path)
+            self.index.remove(self.source_path, relative_path)
+            print ("Removed thumbs for %s" % relative_path)
+
+    def remove_all_thumbs(self, relative_path):
+        # Also the thumbs that aren't in the index, like the ones generated on request
+        for profile in self.profiles:
+            thumb_path = self.thumb_path(profile, relative_path)
+            if self.cache is not None:
+                self.cache.remove(thumb_path)
+            try:
+                os.remove(thumb_path)
+            except OSError:
+                continue
+            remove_empty_dirs(os.path.dirname(thumb_path), self.target_path)
+
+    def remove_thumbs(self, relative_path, thumbs):
+        for profile, thumb in self.thumb_profiles(thumbs):
+            thumb_path = self.thumb_path(profile, relative_path)
+            try:
+                os.remove(thumb_path)
+            except OSError:
+                pass
+            remove_empty_dirs(os.path.dirname(thumb_path), self.target_path)
+
+    def is_available(self):
+        # A missing, empty or unmounted source looks the same as one where every image has been removed
+        try:
+            with os.scandir(self.source_path) as entries:
+                if next(entries, None) is None:
+                    return False
+        except OSError:
+            return False
+        return os.path.ismount(self.source_path) or not self.mounted
+
+    def sweep(self):
+        if not self.is_available():
+            print("Skipping sweep of index of %s, the source is not available" % self.source_path)
+            return
+
+        print("Sweeping index of %s for removed images" % self.source_path)
+
+        for relative_path in self.index.entries(self.source_path):
+            if not os.path.exists(os.path.join(self.source_path, relative_path)):
+                # Check again in case the source has gone away while sweeping
+                if not self.is_available():
+                    print("Stopped sweeping index of %s, the source is not available" % self.source_path)
+                    self.index.commit()
+                    return
+                self.remove(relative_path)
+            yield
+
+        for path in self.scanner.paths(self.source_path):
+            if not os.path.isdir(path):
+                self.scanner.forget(path)
+            yield
+
+        self.index.commit()
+
+    def walk(self, jobs, path, relative_dir):
+        # Load what has already been generated so the target tree doesn't have to be checked for every file
+        with self.metrics.measure('walk'):
+            entries = self.index.entries(self.source_path, relative_dir)
+            directories = self.scanner.scan(path)
+
+        # Go through the changed directories and find image files that doesn't have up to date thumbnails and then generate them
+        while True:
+            with self.metrics.measure('walk'):
+                directory = next(directories, None)
+            if directory is None:
+                break
+
+            # Fix the mtimes of the whole directory in the same traversal, the stats from the listing are outdated after that
+            stat = None
+            if self.exif is not None:
+                self.exif.update_dir(directory.path, directory.files)
+                try:
+                    stat = os.stat(directory.path)
+                except OSError:
+                    pass
+
+            walked = WalkedDirectory(self.scanner, directory, stat)
+            for file in directory.files:
+                if self.is_image(file.name):
+                    # Images still being written are handled once they have settled
+                    if file.path in self.pending:
+                        continue
+                    relative_path = os.path.relpath(file.path, self.source_path)
+                    self.update_file(jobs, relative_path, entries.get(relative_path), file if self.exif is None else None, walked)
+                    yield relative_path
+
+            walked.completed()
+
+    def update_file(self, jobs, relative_path, entry, file=None, walked=None):
+        with self.metrics.measure('check'):
+            # The file may already be gone again, then there is nothing to generate. The stat of a listed file is reused
+            try:
+                stat = file.stat() if file is not None else os.stat(os.path.join(self.source_path, relative_path))
+            except OSError:
+                return
+
+            unchanged = entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns)
+
+            # Older images only get thumbs when they are requested, see ThumbnailServer. They are still in the index to be in the manifests
+            if not self.is_eager(stat.st_mtime):
+                if not unchanged:
+                    # A thumb generated on request for the image as it was would otherwise be served as it is
+                    if entry is not None:
+                        self.remove_all_thumbs(relative_path)
+                    self.index.record(self.source_path, relative_path, stat.st_size, stat.st_mtime_ns, (), info=self.describe(relative_path, ()))
+                return
+
+            if unchanged:
+                existing, info = entry[2], entry[3]
+            elif entry is None:
+                # Thumbs generated before the index existed are trusted as long as the source hasn't changed
+                existing = self.existing_thumbs(relative_path)
+                info = self.describe(relative_path, existing) if len(existing) > 0 else None
+            else:
+                existing, info = (), None
+
+            # Only generate the profiles that are missing, e.g. when a new profile has been added
+            missing = [profile for profile in self.profiles if str(profile) not in existing]
+
+        if len(missing) == 0:
+            if entry is None:
+                self.index.record(self.source_path, relative_path, stat.st_size, stat.st_mtime_ns, existing, info=info)
+            return
+
+        thumbs = tuple(str(profile) for profile in self.profiles)
+        hashes = (None, None)
+        if self.dedupe:
+            with self.metrics.measure('dedupe'):
+                linked, partial, content, duplicate_info = self.link_duplicate(relative_path, stat, missing)
+            if linked:
+                self.metrics.add('linked_total')
+                self.index.record(self.source_path, relative_path, stat.st_size, stat.st_mtime_ns, thumbs, partial, content, merge_info(info, duplicate_info))
+                return
+            hashes = (partial, content)
+
+        def generated(generated_info):
+            self.index.record(self.source_path, relative_path, stat.st_size, stat.st_mtime_ns, thumbs, *hashes, info=merge_info(info, generated_info))
+            if walked is not None:
+                walked.completed()
+
+        def failed():
+            # Make sure the directory is listed again on the next scan so the image is retried
+            self.scanner.forget(os.path.dirname(os.path.join(self.source_path, relative_path)))
+            if walked is not None:
+                walked.completed()
+
+        if walked is not None:
+            walked.started()
+        jobs.submit(
+            relative_path,
+            generated,
+            os.path.join(self.source_path, relative_path),
+            {profile.name: self.thumb_path(profile, relative_path) for profile in missing},
+            failed,
+            self.header(relative_path, stat)
+        )
+
+    def header(self, relative_path, stat=None):
+        # From the media index when another script or an earlier run has parsed it, otherwise it's parsed where it's needed
+        if self.media is None:
+            return None
+        path = os.path.join(self.source_path, relative_path)
+        try:
+            return self.media.header(path, stat or os.stat(path))
+        except OSError:
+            return None
+
+    def link_duplicate(self, relative_path, stat, missing):
+        # Links the missing thumbs from a copy of the same image if there is one, the hashes are returned either way so they can be saved
+        path = os.path.join(self.source_path, relative_path)
+        partial = partial_hash(path, stat.st_size)
+        content = None
+
+        for source_path, duplicate_path, size, mtime, thumbs, duplicate_content, duplicate_info in self.index.duplicates(partial):
+            if (source_path, duplicate_path) == (self.source_path, relative_path) or any(str(profile) not in thumbs for profile in missing):
+                continue
+
+            # The duplicate must still be the same file that its thumbs were generated from
+            try:
+                duplicate_stat = os.stat(os.path.join(source_path, duplicate_path))
+            except OSError:
+                continue
+            if (duplicate_stat.st_size, duplicate_stat.st_mtime_ns) != (size, mtime):
+                continue
+
+            # Confirm with a hash of the whole files, which is only needed when the partial hashes are the same
+            if duplicate_content is None:
+                duplicate_content = content_hash(os.path.join(source_path, duplicate_path))
+                self.index.record_content_hash(source_path, duplicate_path, duplicate_content)
+            if content is None:
+                content = content_hash(path)
+            if content != duplicate_content:
+                continue
+
+            try:
+                for profile in missing:
+                    thumb_path = self.thumb_path(profile, relative_path)
+                    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+                    if os.path.exists(thumb_path):
+                        os.remove(thumb_path)
+                    os.link(self.thumb_path(profile, duplicate_path), thumb_path)
+            except OSError as e:
+                print ("Error linking thumbs for %s to %s: %s" % (relative_path, duplicate_path, e))
+                break
+
+            print ("Linked thumbs for %s to %s" % (relative_path, duplicate_path))
+            return True, partial, content, duplicate_info
+
+        return False, partial, content, None
+
+    def describe(self, relative_path, thumbs):
+        # The same as ThumbnailGenerator reports, for images and thumbs that it didn't make
+        try:
+            header = self.header(relative_path) or read_header(os.path.join(self.source_path, relative_path))
+        except OSError:
+            return None
+
+        info = image_info(header.width, header.height, header.orientation, header)
+        for profile, thumb in self.thumb_profiles(thumbs):
+            thumb_path = self.thumb_path(profile, relative_path)
+            try:
+                thumb_header = read_header(thumb_path)
+                info['thumbs'][profile.name] = (thumb_header.width, thumb_header.height, os.path.getsize(thumb_path))
+            except OSError:
+                pass
+        return info
+
+
+class ThumbnailScheduler:
+    def __init__(self, thumbs, jobs, settle, sweep_interval, metrics=None):
+        self.thumbs = thumbs
+        self.jobs = jobs
+        self.settle = settle
+        self.sweep_interval = sweep_interval
+        self.metrics = metrics or ThumbnailMetrics()
+        self.sweeper = None
+        self.next_sweep = time.time() + sweep_interval
+
+    def run(self):
+        while True:
+            self.thumbs.collect(self.jobs, self.settle)
+            self.export_metrics(False)
+
+            # Images that are done being written goes before everything else
+            settled = self.thumbs.settled(self.settle)
+            self.thumbs.fix_mtimes(settled)
+            for mtime, thumb, relative_path in settled:
+                thumb.update_path(self.jobs, relative_path)
+            if len(settled) > 0:
+                continue
+
+            # Only a few images of a walk at a time, the queue of jobs keeps the walk from getting too far ahead
+            if self.thumbs.backfill(self.jobs, BACKFILL_BATCH):
+                continue
+
+            self.thumbs.finish(self.jobs)
+
+            if self.sweep_interval > 0 and (self.sweeper is not None or time.time() >= self.next_sweep):
+                self.sweep()
+
+            self.export_metrics(True)
+            self.thumbs.wait(self.timeout())
+
+    def sweep(self):
+        # Sweep only while there is nothing else to do and continue where it stopped after the next update
+        self.sweeper = self.sweeper or self.thumbs.sweep()
+        for _ in self.sweeper:
+            if self.thumbs.has_events():
+                return
+        self.sweeper = None
+        self.next_sweep = time.time() + self.sweep_interval
+
+    def export_metrics(self, force):
+        images, walks = self.thumbs.pending()
+        self.metrics.set('jobs_pending', len(self.jobs.pending))
+        self.metrics.set('images_pending', images)
+        self.metrics.set('walks_pending', walks)
+        self.metrics.set('pixels_pending', self.jobs.pending_pixels())
+        self.metrics.export(force)
+
+    def timeout(self):
+        wake_at = [t for t in [self.thumbs.next_due(), self.next_sweep if self.sweep_interval > 0 else None] if t is not None]
+        return max(0.0, min(wake_at) - time.time()) if len(wake_at) > 0 else None
+
+
+class ThumbnailServer:
+    def __init__(self, thumbs, generator, cache, workers, budget):
+        self.thumbs = thumbs
+        self.generator = generator
+        self.cache = cache
+        # The same budget as the jobs, so requests for large images can't decode more than the daemon would by itself
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.generating = {}
+        self.semaphore = threading.Semaphore(workers)
+
+    def serve(self, host, port):
+        server = ThreadingHTTPServer((host, port), ThumbnailRequestHandler)
+        server.thumbnails = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print ("Serving thumbnails on http://%s:%s/" % (host, port))
+
+    def find(self, name, relative_path):
+        # The thumb and source image for a request, the first source that has the image is used like the target is shared
+        profile = next((profile for profile in self.thumbs.profiles if profile.name == name), None)
+        relative_path = os.path.normpath(relative_path)
+        if profile is None or os.path.isabs(relative_path) or relative_path.split(os.sep)[0] == os.pardir:
+            return None, None, None
+        for thumb in self.thumbs.thumbs:
+            source_path = os.path.join(thumb.source_path, relative_path)
+            if thumb.is_image(relative_path) and os.path.isfile(source_path):
+                return thumb, thumb.thumb_path(profile, relative_path), source_path
+        return None, None, None
+
+    def thumb(self, name, relative_path):
+        thumb, thumb_path, source_path = self.find(name, relative_path)
+        if thumb_path is None:
+            return None
+
+        if os.path.exists(thumb_path):
+            self.cache.used(thumb_path)
+            return thumb_path
+
+        # Concurrent requests for the same thumb wait for the first one to generate it
+        with self.lock:
+            generating = self.generating.get(thumb_path)
+            first = generating is None
+            if first:
+                generating = self.generating[thumb_path] = threading.Event()
+
+        if not first:
+            generating.wait()
+            return thumb_path if os.path.exists(thumb_path) else None
+
+        try:
+            header = self.generator.source_header(source_path)
+            with self.semaphore, self.budget.reserved(self.generator.image_pixels(source_path, {name: thumb_path}, header, self.budget)):
+                self.generator.generate(source_path, {name: thumb_path}, header)
+            # Thumbs of recent images are kept like the ones generated right away, they will be added to the index by the walk
+            if not thumb.is_eager(os.path.getmtime(source_path)):
+                self.cache.add(thumb_path, os.path.getsize(thumb_path))
+            print ("Generated requested thumb %s" % thumb_path)
+        except self.generator.errors as e:
+            print ("Error generating requested thumb for %s: %s" % (source_path, e))
+        finally:
+            with self.lock:
+                del self.generating[thumb_path]
+            generating.set()
+
+        return thumb_path if os.path.exists(thumb_path) else None
+
+
+class ThumbnailRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # Paths are /<profile>/<path of the image relative to the source>
+        parts = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/').split('/', 1)
+        thumb_path = self.server.thumbnails.thumb(parts[0], parts[1]) if len(parts) == 2 else None
+        if thumb_path is None:
+            self.send_error(404)
+            return
+
+        try:
+            with open(thumb_path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/webp' if thumb_path.endswith('.webp') else 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 
 if __name__ == "__main__":
@@ -155,30 +1600,64 @@ if __name__ == "__main__":
     parser.add_argument("--source", action='append', required=True, help="The source folder to read from")
     parser.add_argument('--target', required=True, help="The target folder to save the thumbnails in")
     parser.add_argument("--init", action="store_true", default=False, help="Makes an initial check on start")
-    parser.add_argument("--sleep", type=int, default=10, help="Time to sleep between checks if an event has happened")
+    parser.add_argument("--settle", type=float, default=0.5, help="Seconds an image must be left unchanged before generating thumbnails for it")
+    parser.add_argument("--sleep", type=int, help="Deprecated and ignored, kept so old command lines still work. Changes are handled as soon as they have settled, see --settle")
+    parser.add_argument("--workers", type=int, default=1, help="Amount of processes to generate thumbnails in")
+    parser.add_argument("--walk-threads", type=int, default=WALK_THREADS, help="Amount of threads listing directories ahead of the walk, shared by all sources")
+    parser.add_argument("--pixel-budget", type=float, default=PIXEL_BUDGET_MEGAPIXELS, help="Megapixels that may be decoded at the same time by the workers, larger images are decoded one at a time")
+    parser.add_argument("--sweep-interval", type=int, default=86400, help="Seconds between sweeps that removes thumbs for images that no longer exists, 0 to disable")
+    parser.add_argument("--dedupe", action="store_true", default=False, help="Hardlinks the thumbs of identical images instead of generating them for every copy")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=PgmagickBackend.name, help="The library used for decoding, resizing and encoding")
+    parser.add_argument("--exif-preview", action="store_true", default=False, help="Makes the thumbs from the preview embedded in the EXIF data when it's large enough for every missing size")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="Port to serve thumbs on at /PROFILE/PATH, thumbs that doesn't exist yet are generated when requested")
+    parser.add_argument("--serve-host", default="127.0.0.1", help="Address to serve thumbs on, defaults to only local connections")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE_MB, help="Megabytes of thumbs generated on request to keep, the least recently used are removed first")
+    parser.add_argument("--eager-days", type=float, help="Only generate thumbs right away for images modified within this many days, older are generated when requested")
+    parser.add_argument("--metrics-file", help="File to write metrics to in the Prometheus text format, e.g. for the textfile collector of node_exporter")
+    parser.add_argument("--metrics-port", type=int, help="Port to serve metrics in the Prometheus text format on at /metrics")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="Address to serve metrics on, defaults to only local connections")
+    parser.add_argument("--media-index", help="File to share the dimensions and dates read from the images in with directory_exif_mtime.py, so every image is only parsed by one of them")
+    parser.add_argument("--fix-mtime", metavar="TIMEZONE", help="Also sets the modified time of the images and folders to the date in the EXIF data like directory_exif_mtime.py, in the same traversal and before the thumbs are indexed")
+    parser.add_argument("--profile", action='append', type=parse_profile, help="A thumbnail size as NAME:WIDTHxHEIGHT[:fit|crop[:FORMAT[:QUALITY]]] saved in a subfolder named NAME, FORMAT is one of %s. Defaults to large:%sx%s and small:%sx%s:crop" % (', '.join(OUTPUT_FORMATS), LARGE_MAX_WIDTH, LARGE_MAX_HEIGHT, SMALL_WIDTH_AND_HEIGHT, SMALL_WIDTH_AND_HEIGHT))
 
     args = parser.parse_args()
+    if args.sleep is not None:
+        print("--sleep is deprecated and ignored, see --settle")
 
-    generator = ThumbnailGenerator()
+    profiles = args.profile or DEFAULT_PROFILES
+    if len(set(profile.name for profile in profiles)) != len(profiles):
+        parser.error("Profile names must be unique")
+
+    metrics = ThumbnailMetrics(args.metrics_file)
+    if args.metrics_port:
+        metrics.serve(args.metrics_host, args.metrics_port)
+
+    try:
+        backend = BACKENDS[args.backend]()
+    except RuntimeError as e:
+        parser.error(str(e))
+
+    generator = ThumbnailGenerator(profiles, exif_preview=args.exif_preview, backend=backend)
+    jobs = ThumbnailJobs(generator, args.workers, metrics, int(args.pixel_budget * 1000000))
 
     # Merge multiple source-paths to a list of generators
-    thumbs = CompositeThumbnailDirectory(args.source)
+    media = MediaIndex(args.media_index) if args.media_index else None
+    thumbs = CompositeThumbnailDirectory(args.source, args.target, profiles, args.dedupe, metrics, args.eager_days, args.walk_threads, media, args.fix_mtime, args.cache_size * 1024 * 1024 if args.serve or args.eager_days is not None else None)
 
-    # Check if an update should trigger at start
-    if args.init:
-        thumbs.update(generator)
+    if args.serve:
+        ThumbnailServer(thumbs, generator, thumbs.cache, args.workers, jobs.budget).serve(args.serve_host, args.serve)
 
     # Observe all changes in the source folders
     observer = Observer()
     thumbs.observe(observer)
     observer.start()
 
-    # Only start the generating of thumbnails in intervals, not every time a file is changed
+    # Check if an update should trigger at start, it's done in the background so new images are still handled right away
+    if args.init:
+        thumbs.rescan()
+
     try:
-        while True:
-            if thumbs.needs_update():
-                thumbs.update(generator)
-            time.sleep(args.sleep)
+        ThumbnailScheduler(thumbs, jobs, args.settle, args.sweep_interval, metrics).run()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
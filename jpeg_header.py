@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+# Start of frame markers, the others in the range are huffman/arithmetic tables
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_THUMBNAIL_OFFSET = 0x0201
+TAG_THUMBNAIL_LENGTH = 0x0202
+
+
+class JpegHeader:
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.orientation = None
+        self.datetime = None
+        self.datetime_original = None
+        self.thumbnail = None
+        # If an EXIF segment was found, the values above are then missing because the image doesn't have them
+        self.exif = False
+
+
+def read_header(path, thumbnail=False):
+    with open(path, 'rb') as f:
+        return parse_header(f, thumbnail)
+
+
+def parse_header(f, thumbnail=False):
+    # Only reads the segments before the image data, everything that isn't needed is skipped with a seek
+    header = JpegHeader()
+    if f.read(2) != b'\xff\xd8':
+        return header
+
+    try:
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                break
+            code = marker[1]
+            while code == 0xFF:
+                code = f.read(1)[0]
+
+            # Markers without any length or data
+            if code == 0x01 or 0xD0 <= code <= 0xD8:
+                continue
+            # End of image or start of scan, there is no more metadata after this
+            if code in (0xD9, 0xDA):
+                break
+
+            length = struct.unpack('>H', f.read(2))[0]
+            if code == 0xE1 and header.orientation is None and header.datetime is None:
+                data = f.read(length - 2)
+                if data.startswith(b'Exif\x00\x00'):
+                    parse_exif(header, data[6:], thumbnail)
+            elif code in SOF_MARKERS:
+                data = f.read(length - 2)
+                header.height, header.width = struct.unpack('>HH', data[1:5])
+                break
+            else:
+                f.seek(length - 2, 1)
+    except (struct.error, IndexError):
+        pass
+
+    return header
+
+
+def parse_exif(header, tiff, thumbnail):
+    if tiff[:2] == b'II':
+        order = '<'
+    elif tiff[:2] == b'MM':
+        order = '>'
+    else:
+        return
+
+    try:
+        ifd0, ifd1_offset = read_ifd(tiff, struct.unpack(order + 'I', tiff[4:8])[0], order)
+        header.exif = True
+        header.orientation = ifd0.get(TAG_ORIENTATION)
+        header.datetime = ifd0.get(TAG_DATETIME)
+
+        if TAG_EXIF_IFD in ifd0:
+            exif_ifd, _ = read_ifd(tiff, ifd0[TAG_EXIF_IFD], order)
+            header.datetime_original = exif_ifd.get(TAG_DATETIME_ORIGINAL)
+
+        # The second IFD describes the embedded thumbnail, its offset is relative to the TIFF header like everything else
+        if thumbnail and ifd1_offset:
+            ifd1, _ = read_ifd(tiff, ifd1_offset, order)
+            offset = ifd1.get(TAG_THUMBNAIL_OFFSET)
+            length = ifd1.get(TAG_THUMBNAIL_LENGTH)
+            if offset and length and tiff[offset:offset + 2] == b'\xff\xd8':
+                header.thumbnail = tiff[offset:offset + length]
+    except (struct.error, IndexError, ValueError):
+        pass
+
+
+def read_ifd(tiff, offset, order):
+    values = {}
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    for i in range(count):
+        entry = tiff[offset + 2 + i * 12:offset + 14 + i * 12]
+        tag, kind, components = struct.unpack(order + 'HHI', entry[:8])
+        field = entry[8:12]
+
+        if kind == 2:
+            # ASCII is stored in the field itself when it fits, otherwise the field is an offset
+            if components > 4:
+                start = struct.unpack(order + 'I', field)[0]
+                field = tiff[start:start + components]
+            values[tag] = field[:components].split(b'\x00')[0].decode('ascii', 'replace').strip()
+        elif kind == 3:
+            values[tag] = struct.unpack(order + 'H', field[:2])[0]
+        elif kind == 4:
+            values[tag] = struct.unpack(order + 'I', field)[0]
+
+    next_offset = tiff[offset + 2 + count * 12:offset + 6 + count * 12]
+    return values, struct.unpack(order + 'I', next_offset)[0] if len(next_offset) == 4 else 0
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+from jpeg_header import JpegHeader, read_header
+
+MEDIA_INDEX_COMMIT_INTERVAL = 100
+
+
+class MediaIndex:
+    def __init__(self, path):
+        # Shared by directory_thumbnails.py and directory_exif_mtime.py which may be running at the same time
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS media (path TEXT PRIMARY KEY, size INTEGER, inode INTEGER, mtime INTEGER, width INTEGER, height INTEGER, orientation INTEGER, datetime TEXT, datetime_original TEXT, exif INTEGER)")
+        self.connection.commit()
+        self.pending = 0
+
+    def get(self, path, stat):
+        # The mtime is what directory_exif_mtime.py changes, so only the size and inode tells if it's still the same file
+        row = self.connection.execute("SELECT size, inode, width, height, orientation, datetime, datetime_original, exif FROM media WHERE path = ?", (path,)).fetchone()
+        if row is None or row[:2] != (stat.st_size, stat.st_ino):
+            return None
+
+        header = JpegHeader()
+        header.width, header.height, header.orientation, header.datetime, header.datetime_original = row[2:7]
+        header.exif = bool(row[7])
+        return header
+
+    def put(self, path, stat, header):
+        self.connection.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (path, stat.st_size, stat.st_ino, stat.st_mtime_ns, header.width, header.height, header.orientation, header.datetime, header.datetime_original, int(header.exif)))
+        self.pending += 1
+        if self.pending >= MEDIA_INDEX_COMMIT_INTERVAL:
+            self.commit()
+
+    def header(self, path, stat):
+        # The header is only parsed by the first script that needs it
+        header = self.get(path, stat)
+        if header is None:
+            header = read_header(path)
+            self.put(path, stat, header)
+        return header
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
@@ -1,20 +1,33 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from urllib.request import urlopen
-from urllib.error import HTTPError
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 from rfeed import Item, Feed
 from datetime import datetime
 import re
 import argparse
 
+WORKERS = 8
+TIMEOUT = 10
+RETRIES = 3
+
 class TextTVParser:
-    def __init__(self, source, index_pages, categories, max_paragraphs):
+    def __init__(self, source, index_pages, categories, max_paragraphs, workers=WORKERS, timeout=TIMEOUT, retries=RETRIES):
         self.source = source
         self.index_pages = index_pages
         self.categories = categories
         self.max_paragraphs = max_paragraphs
+        self.workers = workers
+        self.timeout = timeout
+
+        # The connections are kept alive and shared by the workers, failed requests are retried with a backoff
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        self.session.mount(source, HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry))
 
     def load_pages(self):
         page_cache = {}
@@ -26,14 +39,22 @@ class TextTVParser:
         return [page for page in pages if page]
 
     def load_cached_pages(self, page_cache, pages):
-        for page in pages:
-            if not page in page_cache:
-                try:
-                    url = self.source + "/" + page
-                    data = urlopen(url).read()
+        # Fetched at the same time, but added in the order they were given so the feed keeps its order
+        pages = [page for page in dict.fromkeys(pages) if not page in page_cache]
+        with ThreadPoolExecutor(max(1, min(self.workers, len(pages)))) as executor:
+            for page, data in zip(pages, executor.map(self.load_page, pages)):
+                if data is not None:
                     page_cache[page] = data
-                except HTTPError as e:
-                    print("Could not load " + url + ", got: " + str(e))
+
+    def load_page(self, page):
+        try:
+            url = self.source + "/" + page
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            return response.content
+        except requests.RequestException as e:
+            print("Could not load " + url + ", got: " + str(e))
+            return None
 
     def parse_page_links(self, page_cache, index_pages):
         article_pages = []
@@ -107,7 +128,10 @@ if __name__ == "__main__":
     parser.add_argument("--index-pages", required=False, nargs="*", default=["101", "102", "103", "104", "105"], help="The index pages which contains a list of pages with the articles")
     parser.add_argument("--categories", required=False, nargs="*", default=["INRIKES","UTRIKES"], help="The categories of news to fetch (e.g. INRIKES, FOTBOLL, SKIDOR)")
     parser.add_argument("--max-paragraphs", required=False, default=1, type=int, help="The amount of paragraphs that max should be included")
+    parser.add_argument("--workers", required=False, default=WORKERS, type=int, help="The amount of pages to fetch at the same time")
+    parser.add_argument("--timeout", required=False, default=TIMEOUT, type=float, help="Seconds to wait for a page before giving up on it")
+    parser.add_argument("--retries", required=False, default=RETRIES, type=int, help="The amount of times to retry a page that failed to load")
 
     args = parser.parse_args()
-    texttv = TextTVParser(args.source, args.index_pages, args.categories, args.max_paragraphs)
+    texttv = TextTVParser(args.source, args.index_pages, args.categories, args.max_paragraphs, args.workers, args.timeout, args.retries)
     print(texttv.to_feed(texttv.load_pages()))